@@ -0,0 +1,94 @@
+import random
+import time
+import tracemalloc
+
+from server.app import app
+from server.html_utils import markup_changes
+from server.sections import diff_sections, separate_sections
+
+
+letters = "abcdefghijklmnopqrstuvwxyz"
+vocab_rng = random.Random(1)
+vocab = [
+    "".join(vocab_rng.choice(letters) for _ in range(vocab_rng.randint(2, 9)))
+    for _ in range(3000)
+]
+weights = [1 / (rank + 1) for rank in range(len(vocab))]
+
+
+def random_paragraph(rng, length=40):
+    words = rng.choices(vocab, weights, k=length)
+    return " ".join(word + rng.choice(["", "", "", ",", "."]) for word in words)
+
+
+def random_page(rng, num_sections=30, paragraphs=3):
+    html = "<div>{}</div>".format(random_paragraph(rng))
+    for i in range(num_sections):
+        html += "<h2>Section {}</h2>".format(i)
+        for _ in range(paragraphs):
+            html += "<div>{} <b>{}</b></div>".format(
+                random_paragraph(rng), random_paragraph(rng, 5)
+            )
+    return html
+
+
+def edit_page(rng, html, num_edits=5):
+    words = html.split(" ")
+    for _ in range(num_edits):
+        i = rng.randrange(len(words))
+        while not words[i].isalpha():
+            i = rng.randrange(len(words))
+        words[i] = rng.choice(["cat", "mouse", "owl"])
+    return " ".join(words)
+
+
+def edit_section(rng, html, section):
+    heading = "<h2>Section {}</h2>".format(section)
+    head, tail = html.split(heading)
+    body, sep, rest = tail.partition("<h2>")
+    return head + heading + edit_page(rng, body) + sep + rest
+
+
+def bench(name, fn, repeat=3):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    fn()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        "{:<28} {:>9.1f} ms {:>9.1f} KiB peak".format(name, elapsed * 1000, peak / 1024)
+    )
+
+
+if __name__ == "__main__":
+    print("diff engine:", app.config["DIFF_ENGINE"])
+    rng = random.Random(0)
+    page_a = random_page(rng)
+    page_b = edit_page(rng, page_a)
+
+    bench("markup_changes", lambda: markup_changes(page_a, page_b))
+    bench(
+        "markup_changes concise", lambda: markup_changes(page_a, page_b, concise=True)
+    )
+    bench("separate_sections", lambda: separate_sections(page_b))
+
+    block_min_tokens = app.config["DIFF_BLOCK_MIN_TOKENS"]
+    app.config["DIFF_BLOCK_MIN_TOKENS"] = float("inf")
+    bench("markup_changes word level", lambda: markup_changes(page_a, page_b))
+    app.config["DIFF_BLOCK_MIN_TOKENS"] = block_min_tokens
+
+    # time diffs themselves rather than round trips to the diff memo
+    app.config["DIFF_MEMO_MIN_LENGTH"] = float("inf")
+    for num_sections in [10, 30, 100, 300]:
+        page_a = random_page(rng, num_sections=num_sections)
+        page_b = edit_section(rng, page_a, num_sections // 2)
+        _summary, sections_a = separate_sections(page_a)
+        _summary, sections_b = separate_sections(page_b)
+        bench(
+            "diff_sections {} sections".format(num_sections),
+            lambda: diff_sections(sections_a, sections_b),
+        )
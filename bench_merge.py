@@ -0,0 +1,54 @@
+import random
+import time
+
+from flask import render_template
+
+from bench_html import random_page, edit_section
+from server.app import app
+from server.sections import separate_sections
+from server.html_utils import merge_html
+from server.user_page import UserVersion
+
+
+def make_version(html):
+    summary, sections = separate_sections(html)
+    return UserVersion(summary=summary, sections=sections, name="A", aka="B")
+
+
+def render_body(version):
+    return render_template("user-page-body.html", version=version)
+
+
+rng = random.Random(0)
+num_sections = 30
+page = random_page(rng, num_sections=num_sections)
+
+with app.app_context():
+    for num_proposals in [1, 10, 100]:
+        original = make_version(page)
+        proposals = [
+            make_version(edit_section(rng, page, rng.randrange(num_sections)))
+            for _ in range(num_proposals)
+        ]
+
+        for proposal in proposals[:-1]:
+            proposal.store_merge_scripts(original)
+
+        # what merging used to cost: render, parse and diff every whole page
+        start = time.perf_counter()
+        separate_sections(
+            merge_html(render_body(original), [render_body(p) for p in proposals])
+        )
+        full = time.perf_counter() - start
+
+        # only the newest proposal is diffed, and only the sections it edited
+        start = time.perf_counter()
+        proposals[-1].store_merge_scripts(original)
+        UserVersion.merge(original, proposals)
+        sections = time.perf_counter() - start
+
+        print(
+            "{:>3} proposals  whole page {:>8.1f} ms  by section {:>8.1f} ms".format(
+                num_proposals, full * 1000, sections * 1000
+            )
+        )
@@ -0,0 +1,292 @@
+import random
+import time
+from types import SimpleNamespace
+
+from bench_html import edit_section, random_page, random_paragraph
+from server.html_utils import (
+    PageSequencer,
+    UnsupportedMarkup,
+    allowed_tags,
+    bleach_clean,
+    bleach_linkify,
+    clean_page,
+    header_tags,
+    linkify,
+)
+from server.sections import separate_sections
+
+
+class Names(dict):
+    # every other title is a page that doesn't exist, so nothing is looked up
+    def __contains__(self, title):
+        return True
+
+    def __missing__(self, title):
+        return None
+
+
+names = Names({"Some_Page": "Some Page", "Some Page": "Some Page"})
+
+urls = [
+    "http://example.com",
+    "https://example.com/a/b?c=1&d=2",
+    "example.org/path_(x)",
+    "(www.example.net/a).",
+    "thread.wiki/page/Some_Page",
+    "https://thread.wiki/page/Other/",
+    "http://thread.wiki/page/Some%20Page,",
+    "pic.example.com/cat.png",
+    "mailto:someone@example.com",
+    "e.g",
+    "javascript:alert(1)",
+    "ftp://example.com/x",
+    "",
+]
+texts = [
+    "&amp;",
+    "&",
+    "&nbsp;",
+    "&copy",
+    "&copy;",
+    "&notin;",
+    "&notit;",
+    "&#169;",
+    "&#x41;",
+    "&#128;",
+    "&#1;",
+    "&#12a;",
+    "&zzz;",
+    "&ampx;",
+    "&lt;b&gt;",
+    "a < b",
+    "1 > 0",
+    "\xa0",
+    " ",
+    "\n",
+    '"quoted"',
+    "it's",
+]
+tags = [
+    "p",
+    "div",
+    "b",
+    "strong",
+    "i",
+    "em",
+    "li",
+    "ul",
+    "ol",
+    "h1",
+    "h2",
+    "h3",
+    "span",
+    "u",
+    "font",
+    "blockquote",
+    "section",
+    "sub",
+    "code",
+    "table",
+    "td",
+    "pre",
+    "script",
+    "style",
+    "textarea",
+    "foo",
+]
+attr_values = [
+    "x",
+    "a&b",
+    "a&amp;b",
+    "&copy=1",
+    "&copy x",
+    "&quot;",
+    'say "hi"',
+    "it's",
+    "\\",
+]
+
+
+def fuzz_attrs(rng, tag):
+    attrs = []
+    for _ in range(rng.choice([0, 0, 1, 2])):
+        name = rng.choice(["href", "title", "src", "class", "onclick"])
+        value = rng.choice(urls + attr_values)
+        quote = rng.choice(['"', "'", ""])
+        if not quote and (not value or set(value) & set(" \"'=<>`")):
+            quote = '"'
+        if quote in value:
+            quote = "'" if quote == '"' else '"'
+        attrs.append(" {}={}{}{}".format(name, quote, value, quote))
+    return "".join(attrs)
+
+
+def fuzz_page(rng, length=40):
+    # tag soup: mismatched, unclosed and stray tags, links and references
+    parts = []
+    for _ in range(length):
+        kind = rng.random()
+        if kind < 0.3:
+            parts.append(random_paragraph(rng, rng.randint(1, 8)))
+        elif kind < 0.4:
+            parts.append(rng.choice(texts))
+        elif kind < 0.5:
+            parts.append(" " + rng.choice(urls) + rng.choice([" ", ". ", ", ", ")"]))
+        elif kind < 0.6:
+            parts.append(
+                "<a{}>{}</a>".format(
+                    fuzz_attrs(rng, "a"), rng.choice(urls + ["text", ""])
+                )
+            )
+        elif kind < 0.65:
+            parts.append("<img{}>".format(fuzz_attrs(rng, "img")))
+        elif kind < 0.7:
+            parts.append(
+                rng.choice(["<br>", "<br/>", "</br>", "<hr>", "<!-- note -->"])
+            )
+        elif kind < 0.85:
+            tag = rng.choice(tags)
+            parts.append("<{}{}>".format(tag, fuzz_attrs(rng, tag)))
+        else:
+            parts.append("</{}>".format(rng.choice(tags)))
+    return "".join(parts)
+
+
+def bleach_page(html):
+    # the chain clean_page replaces
+    summary, sections = separate_sections(
+        bleach_clean(html, allowed_tags + header_tags)
+    )
+    links, summary = bleach_linkify(summary, names)
+    bodies = []
+    for section in sections:
+        section_links, body = bleach_linkify(section.body, names)
+        links |= section_links
+        bodies.append((section.heading, section.level, body))
+    return links, bodies, summary
+
+
+def pipeline_page(html):
+    links, sections, summary = clean_page(html, names)
+    return links, [(s.heading, s.level, s.body) for s in sections], summary
+
+
+def falls_back(html, sanitize=True):
+    parser = PageSequencer(names, sanitize=sanitize)
+    try:
+        parser.feed(html)
+        parser.close()
+    except UnsupportedMarkup:
+        return True
+    except Exception:
+        pass
+    return False
+
+
+def outcome(fn, html):
+    try:
+        return fn(html)
+    except Exception as e:
+        return type(e)
+
+
+def conformance(corpus):
+    mismatches = []
+    fallbacks = 0
+    for html in corpus:
+        fallbacks += falls_back(html)
+        if outcome(bleach_page, html) != outcome(pipeline_page, html):
+            mismatches.append(html)
+    return mismatches, fallbacks
+
+
+def linkify_conformance(corpus):
+    mismatches = []
+    fallbacks = 0
+    for html in corpus:
+        try:
+            _links, bodies, summary = bleach_page(html)
+        except Exception:
+            continue
+        for body in [summary] + [body for _heading, _level, body in bodies]:
+            fallbacks += falls_back(body, sanitize=False)
+            if outcome(lambda b: bleach_linkify(b, names), body) != outcome(
+                lambda b: linkify(b, names), body
+            ):
+                mismatches.append(body)
+    return mismatches, fallbacks
+
+
+def edit_form(version):
+    # the body the edit page shows, submitted back as is
+    return version.summary + "".join(
+        "<h{0}>{1}</h{0}>{2}".format(section.level, section.heading, section.body)
+        for section in version.sections
+    )
+
+
+def resubmit(rng, num_sections, repeat=3):
+    # a whole page submitted with one section edited, against the version it
+    # was edited from
+    html = random_page(rng, num_sections=num_sections).replace(
+        "</div>", " see thread.wiki/page/Some_Page or example.com/x</div>"
+    )
+    _links, sections, summary = clean_page(html, names)
+    previous = SimpleNamespace(sections=sections, summary=summary)
+    edited = edit_section(rng, edit_form(previous), rng.randrange(num_sections))
+    timings = []
+    results = []
+    for kwargs in [{}, {"previous": previous}]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            links, sections, summary = clean_page(edited, names, **kwargs)
+        timings.append((time.perf_counter() - start) / repeat)
+        results.append(
+            (links, [(s.heading, s.level, s.body) for s in sections], summary)
+        )
+    assert results[0] == results[1]
+    print(
+        "{:>3} sections  every section {:>7.1f} ms  edited only {:>7.1f} ms".format(
+            num_sections, timings[0] * 1000, timings[1] * 1000
+        )
+    )
+
+
+def throughput(name, fn, corpus, repeat=3):
+    size = sum(len(html.encode()) for html in corpus)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in corpus:
+            outcome(fn, html)
+    elapsed = (time.perf_counter() - start) / repeat
+    print("{:<28} {:>9.2f} MB/s".format(name, size / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    pages = [random_page(rng, num_sections=10) for _ in range(20)]
+    soup = [fuzz_page(rng) for _ in range(2000)]
+
+    for corpus_name, corpus in [("pages", pages), ("tag soup", soup)]:
+        mismatches, fallbacks = conformance(corpus)
+        print(
+            "{:<10} {} documents, {} differ from bleach, {} fall back".format(
+                corpus_name, len(corpus), len(mismatches), fallbacks
+            )
+        )
+        for html in mismatches[:3]:
+            print("   ", repr(html))
+    mismatches, fallbacks = linkify_conformance(soup)
+    print(
+        "linkify    {} differ from bleach, {} fall back".format(
+            len(mismatches), fallbacks
+        )
+    )
+    for html in mismatches[:3]:
+        print("   ", repr(html))
+
+    throughput("bleach clean and linkify", bleach_page, pages)
+    throughput("clean_page", pipeline_page, pages)
+
+    for num_sections in [10, 30, 100]:
+        resubmit(rng, num_sections)
@@ -0,0 +1,117 @@
+import sys
+import uuid
+
+import pymongo.monitoring
+from flask import url_for
+
+
+class QueryCounter(pymongo.monitoring.CommandListener):
+    reads = {"find", "aggregate", "getMore", "count"}
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name in self.reads:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# registered before the server connects, so its client reports to it
+counter = QueryCounter()
+pymongo.monitoring.register(counter)
+
+from server import app  # noqa: E402
+from server.auth import generate_auth_token  # noqa: E402
+from server.page import Page  # noqa: E402
+from server.user import User  # noqa: E402
+
+# it creates users and pages, so point MONGODB_CONNECT_STRING at a scratch database
+client = app.test_client()
+tag = uuid.uuid4().hex[:6]
+
+
+def login(email):
+    user = User.create_or_return(email)
+    client.set_cookie("localhost", "token", generate_auth_token(user._id))
+
+
+def request(method, url, **params):
+    response = getattr(client, method)(url, json=params, base_url="https://localhost")
+    assert response.status_code == 200, (url, response.status_code)
+    return response
+
+
+def add_pages(start, stop):
+    # a user page with a proposal from the reader, and a topic page with an edit
+    for i in range(start, stop):
+        email = "bench{}.{}@example.com".format(i, tag)
+        title = "Bench_{}_{}".format(i, tag)
+        login(email)
+        request("get", "/page/{}/".format(email))
+        request("get", "/page/{}/".format(title))
+        request(
+            "post",
+            "/page/{}/submitedit/".format(title),
+            body="<div>Bench topic {}</div><h2>Notes</h2><div>notes</div>".format(i),
+            name="Bench {} {}".format(i, tag),
+            freshness=Page.find(title).freshness,
+            errorid="err",
+            href="/",
+        )
+        login("reader.{}@example.com".format(tag))
+        request(
+            "post",
+            "/page/{}/update/".format(email),
+            update={"summary": "<div>Proposed by the reader</div>"},
+            freshness=Page.find(email).freshness,
+            errorid="err",
+            href="/",
+        )
+
+
+def count_queries(url):
+    request("get", url)
+    counter.count = 0
+    request("get", url)
+    return counter.count
+
+
+if __name__ == "__main__":
+    with app.test_request_context():
+        search_url = url_for("search", query=tag)
+    reader = "reader.{}@example.com".format(tag)
+    views = [
+        (reader, "/recent/"),
+        (reader, "/bookmarks/"),
+        (reader, search_url),
+        (None, "/recent/"),
+        (None, search_url),
+    ]
+    counts = {view: [] for view in views}
+    num_pages = 0
+    for size in [2, 4, 8]:
+        add_pages(num_pages, size)
+        num_pages = size
+        for who, url in views:
+            if who is None:
+                client.delete_cookie("localhost", "token")
+            else:
+                login(who)
+            counts[who, url].append(count_queries(url))
+    print("queries with 2, 4 and 8 pages of each kind")
+    for who, url in views:
+        print(
+            "{:<10} {:<24} {}".format(
+                "reader" if who else "anonymous",
+                url,
+                " ".join(str(n) for n in counts[who, url]),
+            )
+        )
+    if any(len(set(counts[view])) > 1 for view in views):
+        sys.exit("query counts grow with the number of pages listed")
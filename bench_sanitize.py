@@ -0,0 +1,50 @@
+import random
+import time
+
+import bleach
+
+from bench_html import random_page
+from bench_pipeline import texts, urls
+from server.html_utils import (
+    allowed_attrs,
+    allowed_tags,
+    sanitize_paragraph,
+    sanitize_text,
+)
+
+
+def bleach_sanitizer(tags):
+    # what the sanitizers used to be
+    if tags:
+        return lambda html: bleach.clean(
+            str(html), tags=tags, attributes=allowed_attrs, strip=True
+        )
+    return lambda text: bleach.clean(str(text), tags=[], strip=True)
+
+
+def fuzz_name(rng):
+    # names and akas: mostly text, sometimes with markup pasted in
+    parts = [rng.choice(["Ada", "Lovelace", "Grace Hopper", "MIT", "O'Brien"])]
+    for _ in range(rng.randint(0, 3)):
+        parts.append(rng.choice(texts + urls + ["<b>", "</i>", "<br>", "<!-- x -->"]))
+    return " ".join(parts)
+
+
+def throughput(name, fn, corpus, repeat=3):
+    size = sum(len(html.encode()) for html in corpus)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in corpus:
+            fn(html)
+    elapsed = (time.perf_counter() - start) / repeat
+    print("{:<28} {:>9.2f} MB/s".format(name, size / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    pages = [random_page(rng, num_sections=10) for _ in range(20)]
+    names = [fuzz_name(rng) for _ in range(2000)]
+    throughput("bleach.clean pages", bleach_sanitizer(allowed_tags), pages)
+    throughput("sanitize_paragraph pages", sanitize_paragraph, pages)
+    throughput("bleach.clean names", bleach_sanitizer([]), names)
+    throughput("sanitize_text names", sanitize_text, names)
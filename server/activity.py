@@ -0,0 +1,46 @@
+from pymodm import fields, MongoModel
+from pymongo import DESCENDING
+
+from .page import Page, VersionDiff, ref_id
+
+
+class Activity(MongoModel):
+    # an edit as listed on /recent/. the collection is capped, so it is only
+    # ever appended to, and is read newest first by _id
+    page = fields.ReferenceField(Page)
+    title = fields.CharField()
+    name = fields.CharField()
+    timestamp = fields.DateTimeField()
+    diff = fields.ReferenceField(VersionDiff)
+
+    @staticmethod
+    def record(page, diff):
+        Activity(
+            page=page,
+            title=page.title,
+            name=page.name,
+            timestamp=page.last_edited,
+            diff=diff,
+        ).save()
+
+    @staticmethod
+    def recent(before=None, limit=20):
+        # the edits before the given _id, and all their diffs in one more
+        # query, with the _id to go back from for older ones if there may be
+        # any. edits whose diff is missing are left out
+        query = {} if before is None else {"_id": {"$lt": before}}
+        activities = list(
+            Activity.objects.raw(query).order_by([("_id", DESCENDING)]).limit(limit)
+        )
+        older = activities[-1]._id if len(activities) == limit else None
+        diff_ids = [ref_id(activity, "diff") for activity in activities]
+        diffs = {
+            diff._id: diff
+            for diff in VersionDiff.objects.raw({"_id": {"$in": diff_ids}})
+        }
+        found = []
+        for activity, diff_id in zip(activities, diff_ids):
+            if diff_id in diffs:
+                activity.diff = diffs[diff_id]
+                found.append(activity)
+        return found, older
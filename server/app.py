@@ -5,6 +5,24 @@
 # MONGODB_CONNECT_STRING=mongodb://localhost:27017/thread_dev
 # AWS_ACCESS_KEY_ID=<access key>
 # AWS_SECRET_ACCESS_KEY=<secret key>
+# optional:
+# DIFF_ENGINE=difflib|myers
+# SEQUENCE_CACHE_TOKENS=<max tokens kept in the parsed sequence cache>
+# DIFF_MEMO_TTL=<seconds stored section diffs are kept>
+# DIFF_MEMO_MIN_LENGTH=<combined body length before diffs are stored>
+# DIFF_BLOCK_MIN_TOKENS=<body length in tokens before blocks are aligned first>
+# DIFF_BUDGET_TOKENS=<largest changed window that gets matched word by word>
+# DIFF_BUDGET_SECONDS=<time spent diffing a version before falling back>
+# DIFF_OFFLOAD_WORKERS=<processes for large diffs and merges, auto for one per core, 0 to run them inline>
+# DIFF_OFFLOAD_MIN_LENGTH=<combined input length before work is offloaded>
+# DIFF_OFFLOAD_TIMEOUT=<seconds to wait for an offloaded diff or merge>
+# NAME_CACHE_SIZE=<titles whose page names are kept for linkify>
+# NAME_CACHE_TTL=<seconds before a cached page name is looked up again>
+# STATS_ENABLED=<1 to serve cache statistics on /stats/>
+# HISTORY_PAGE_SIZE=<edits shown at a time on history pages>
+# ACTIVITY_FEED_BYTES=<size of the capped collection edits are listed from on /recent/>
+# BACKLINK_ATTEMPTS=<times a backlink is tried before it's dropped>
+# BACKLINK_BACKOFF_SECONDS=<wait before a backlink is retried, doubling each time>
 
 import os
 from datetime import datetime
@@ -22,6 +40,38 @@ app.config.update(
 )
 moment = Moment(app)
 
+# the names of the matchers in diff.engines
+diff_engines = ["difflib", "myers"]
+offload_workers = os.environ.get("DIFF_OFFLOAD_WORKERS", "0")
+app.config.update(
+    DIFF_ENGINE=os.environ.get("DIFF_ENGINE", "difflib"),
+    SEQUENCE_CACHE_TOKENS=int(os.environ.get("SEQUENCE_CACHE_TOKENS", 200000)),
+    DIFF_MEMO_TTL=int(os.environ.get("DIFF_MEMO_TTL", 3600 * 24 * 30)),
+    DIFF_MEMO_MIN_LENGTH=int(os.environ.get("DIFF_MEMO_MIN_LENGTH", 2000)),
+    DIFF_BLOCK_MIN_TOKENS=int(os.environ.get("DIFF_BLOCK_MIN_TOKENS", 1000)),
+    DIFF_BUDGET_TOKENS=int(os.environ.get("DIFF_BUDGET_TOKENS", 3000)),
+    DIFF_BUDGET_SECONDS=float(os.environ.get("DIFF_BUDGET_SECONDS", 2)),
+    DIFF_OFFLOAD_WORKERS=(
+        os.cpu_count() if offload_workers == "auto" else int(offload_workers)
+    ),
+    DIFF_OFFLOAD_MIN_LENGTH=int(os.environ.get("DIFF_OFFLOAD_MIN_LENGTH", 20000)),
+    DIFF_OFFLOAD_TIMEOUT=float(os.environ.get("DIFF_OFFLOAD_TIMEOUT", 10)),
+    NAME_CACHE_SIZE=int(os.environ.get("NAME_CACHE_SIZE", 10000)),
+    NAME_CACHE_TTL=float(os.environ.get("NAME_CACHE_TTL", 300)),
+    STATS_ENABLED=os.environ.get("STATS_ENABLED") == "1",
+    HISTORY_PAGE_SIZE=int(os.environ.get("HISTORY_PAGE_SIZE", 20)),
+    ACTIVITY_FEED_BYTES=int(os.environ.get("ACTIVITY_FEED_BYTES", 16 * 1024 * 1024)),
+    BACKLINK_ATTEMPTS=int(os.environ.get("BACKLINK_ATTEMPTS", 8)),
+    BACKLINK_BACKOFF_SECONDS=float(os.environ.get("BACKLINK_BACKOFF_SECONDS", 2)),
+)
+
+if app.config["DIFF_ENGINE"] not in diff_engines:
+    raise ValueError(
+        "DIFF_ENGINE is {!r}, but has to be one of {}".format(
+            app.config["DIFF_ENGINE"], ", ".join(diff_engines)
+        )
+    )
+
 if "FLASK_SERVER_NAME" in os.environ:
     app.config.update(SERVER_NAME=os.environ["FLASK_SERVER_NAME"])
 
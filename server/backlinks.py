@@ -0,0 +1,115 @@
+import time
+import traceback
+from datetime import timedelta
+
+import click
+from flask import g
+from pymodm import fields, MongoModel
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.operations import IndexModel
+
+from .app import app, timestamp
+from .page import Page
+from .errors import *
+
+# how long a claimed job stays hidden from other workers, in case the worker
+# running it dies
+lease = timedelta(minutes=5)
+poll_seconds = 1
+
+
+class BacklinkJob(MongoModel):
+    # a link from the page with these titles to the page titled target, to be
+    # linked back by editor
+    titles = fields.ListField(fields.CharField())
+    target = fields.CharField()
+    editor = fields.ReferenceField("User")
+    attempts = fields.IntegerField(default=0)
+    run_after = fields.DateTimeField()
+
+    class Meta:
+        indexes = [IndexModel("run_after")]
+
+
+def queue_backlinks(page, targets):
+    if not targets:
+        return
+    now = timestamp()
+    BacklinkJob.objects.bulk_create(
+        [
+            BacklinkJob(titles=page.titles, target=target, editor=g.user, run_after=now)
+            for target in targets
+        ]
+    )
+
+
+def claim_job():
+    now = timestamp()
+    document = BacklinkJob._mongometa.collection.find_one_and_update(
+        {"run_after": {"$lte": now}},
+        {"$set": {"run_after": now + lease}, "$inc": {"attempts": 1}},
+        sort=[("run_after", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+    if document is None:
+        return None
+    return BacklinkJob.from_document(document)
+
+
+def add_backlink(job):
+    try:
+        page = Page.find(job.target)
+    except PageNotFound:
+        return
+    # add_backlink does nothing if the page already links back, so a job that
+    # ran before without being marked done is safe to run again
+    if page.can_edit:
+        page.add_backlink(job.titles)
+
+
+def retry_later(job):
+    if job.attempts >= app.config["BACKLINK_ATTEMPTS"]:
+        click.echo(
+            "Giving up on linking {} back to {}".format(job.target, job.titles[-1])
+        )
+        job.delete()
+        return
+    delay = app.config["BACKLINK_BACKOFF_SECONDS"] * 2 ** (job.attempts - 1)
+    BacklinkJob.objects.raw({"_id": job._id}).update(
+        {"$set": {"run_after": timestamp() + timedelta(seconds=delay)}}
+    )
+
+
+def run_job(job):
+    # edits are made as the editor whose edit added the link, like they were
+    # when backlinks were made in the edit's request
+    try:
+        with app.test_request_context():
+            g.user = job.editor
+            add_backlink(job)
+    except RaceCondition:
+        retry_later(job)
+    except Exception:
+        traceback.print_exc()
+        retry_later(job)
+    else:
+        job.delete()
+
+
+def run_jobs():
+    # until none are due, returning how many were run
+    num_run = 0
+    job = claim_job()
+    while job is not None:
+        run_job(job)
+        num_run += 1
+        job = claim_job()
+    return num_run
+
+
+@app.cli.command("backlinks-worker")
+def backlinks_worker():
+    """Make the backlinks that edits queue up, and wait for more until stopped."""
+    while True:
+        if run_jobs() == 0:
+            time.sleep(poll_seconds)
@@ -1,4 +1,5 @@
 from pymodm import fields, MongoModel
+from pymodm.context_managers import no_auto_dereference
 from pymodm.errors import DoesNotExist
 from pymongo.errors import DuplicateKeyError
 from pymongo.operations import IndexModel
@@ -6,10 +7,17 @@ from flask import g, render_template
 from urllib.parse import urljoin
 
 from .app import timestamp, url_for
-from .page import Page
+from .page import Page, prefetch
 from .user_page import UserPage
-from .html_utils import markup_changes, linkify_page, sanitize_html, split_words
-from .sections import diff_sections, separate_sections, Section, SectionDiff
+from .html_utils import linkify_page, sanitize_html, split_words
+from .sections import (
+    diff_bodies,
+    diff_sections,
+    separate_sections,
+    Section,
+    SectionDiff,
+)
+from .diff import DiffBudget
 from .errors import *
 
 
@@ -37,13 +45,15 @@ class BookmarksPage(MongoModel):
         diff.save()
         self.versions.append(version)
         self.diffs.append(diff)
+        self._latest = version
         self.save()
 
     @staticmethod
     def search(query):
         bookmarks = BookmarksPage.find()
         links = bookmarks.latest.links
-        pages = list(Page.objects.raw({"titles": {"$in": links}}).all())
+        pages = Page.objects.raw({"titles": {"$in": links}}).project({"head": 0})
+        pages = prefetch(list(pages), "user_version")
         query_terms = to_terms(query)
         matches = []
         for page in pages:
@@ -57,7 +67,14 @@ class BookmarksPage(MongoModel):
 
     @property
     def latest(self):
-        return self.versions[-1]
+        # just the last version, instead of dereferencing every one
+        if not hasattr(self, "_latest"):
+            with no_auto_dereference(BookmarksPage):
+                latest = self.versions[-1]
+            self._latest = BookmarksVersion.objects.get(
+                {"_id": getattr(latest, "_id", latest)}
+            )
+        return self._latest
 
     def add_bookmark(self, title):
         sections = self.latest.sections[:]
@@ -78,9 +95,14 @@ class BookmarksPage(MongoModel):
             return True
         return False
 
-    def edit(self, sections, summary):
+    def edit(self, sections, summary, links=None, previous=None):
         assert g.user is not None
-        links, sections, summary = linkify_page(sections, summary)
+        # links is given when the sections come from clean_page, already linked,
+        # and previous is the version they were edited from
+        if links is None:
+            links, sections, summary = linkify_page(
+                sections, summary, previous=previous
+            )
         version = BookmarksVersion(
             page=self,
             timestamp=timestamp(),
@@ -149,6 +171,7 @@ class BookmarksDiff(MongoModel):
     summary = fields.CharField(blank=True)
     summary_diff = fields.CharField(blank=True)
     summary_changed = fields.BooleanField()
+    summary_degraded = fields.BooleanField(default=False)
 
     @property
     def is_empty(self):
@@ -159,8 +182,11 @@ class BookmarksDiff(MongoModel):
 
     @staticmethod
     def compute(version_a, version_b):
-        sections = diff_sections(version_a.sections, version_b.sections)
-        summary_diff = markup_changes(version_a.summary, version_b.summary)
+        budget = DiffBudget()
+        sections = diff_sections(version_a.sections, version_b.sections, budget=budget)
+        summary_diff, summary_degraded = diff_bodies(
+            version_a.summary, version_b.summary, False, budget
+        )
         return BookmarksDiff(
             version_a=version_a,
             version_b=version_b,
@@ -168,4 +194,5 @@ class BookmarksDiff(MongoModel):
             summary=version_b.summary,
             summary_diff=summary_diff,
             summary_changed=version_a.summary != version_b.summary,
+            summary_degraded=summary_degraded,
         )
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_hash(data):
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, max_cost, cost=len, ttl=None):
+        self.max_cost = max_cost
+        self.cost = cost
+        self.ttl = ttl
+        self.total_cost = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, cost, expires = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.total_cost -= cost
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        cost = self.cost(value)
+        if cost > self.max_cost:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if key in self.entries:
+                _, old_cost, _ = self.entries.pop(key)
+                self.total_cost -= old_cost
+            self.entries[key] = (value, cost, expires)
+            self.total_cost += cost
+            while self.total_cost > self.max_cost:
+                _, (_, evicted_cost, _) = self.entries.popitem(last=False)
+                self.total_cost -= evicted_cost
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                _, cost, _ = self.entries.pop(key)
+                self.total_cost -= cost
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                entries=len(self.entries),
+                cost=self.total_cost,
+                max_cost=self.max_cost,
+            )
@@ -0,0 +1,344 @@
+import time
+from difflib import SequenceMatcher
+
+from .app import app, diff_engines
+
+
+class DifflibMatcher(SequenceMatcher):
+    name = "difflib"
+    version = 2
+
+    def __init__(self, a, b):
+        super().__init__(isjunk=None, a=a, b=b, autojunk=False)
+
+
+def to_ids(sequence_a, sequence_b):
+    vocabulary = {}
+    ids_a = [vocabulary.setdefault(item, len(vocabulary)) for item in sequence_a]
+    ids_b = [vocabulary.setdefault(item, len(vocabulary)) for item in sequence_b]
+    return ids_a, ids_b
+
+
+def common_prefix(a, alo, ahi, b, blo, bhi):
+    n = 0
+    while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+        n += 1
+    return n
+
+
+def common_suffix(a, alo, ahi, b, blo, bhi):
+    n = 0
+    while alo < ahi - n and blo < bhi - n and a[ahi - n - 1] == b[bhi - n - 1]:
+        n += 1
+    return n
+
+
+def prefix_length(a, b):
+    # slices of int lists compare in C, so the first mismatch is found by
+    # comparing progressively smaller chunks instead of item by item
+    n = min(len(a), len(b))
+    i = 0
+    step = 256
+    while step:
+        while i + step <= n and a[i : i + step] == b[i : i + step]:
+            i += step
+        step //= 2
+    return i
+
+
+def suffix_length(a, b, prefix=0):
+    n = min(len(a), len(b)) - prefix
+    len_a = len(a)
+    len_b = len(b)
+    i = 0
+    step = 256
+    while step:
+        while i + step <= n and (
+            a[len_a - i - step : len_a - i] == b[len_b - i - step : len_b - i]
+        ):
+            i += step
+        step //= 2
+    return i
+
+
+def middle_snake(a, alo, ahi, b, blo, bhi):
+    # linear space bisection from Myers' "An O(ND) Difference Algorithm and
+    # Its Variations": run the greedy search forwards from the start and
+    # backwards from the end of the window until the two paths overlap, and
+    # return the overlap point relative to (alo, blo)
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    forward = [-1] * (2 * max_d + 2)
+    forward[offset + 1] = 0
+    backward = forward[:]
+    delta = n - m
+    odd = delta % 2 != 0
+    forward_start = forward_end = backward_start = backward_end = 0
+    for d in range(max_d):
+        for k in range(-d + forward_start, d + 1 - forward_end, 2):
+            k_offset = offset + k
+            if k == -d or (k != d and forward[k_offset - 1] < forward[k_offset + 1]):
+                x = forward[k_offset + 1]
+            else:
+                x = forward[k_offset - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[k_offset] = x
+            if x > n:
+                forward_end += 2
+            elif y > m:
+                forward_start += 2
+            elif odd:
+                reverse_offset = offset + delta - k
+                if (
+                    0 <= reverse_offset < len(backward)
+                    and backward[reverse_offset] != -1
+                ):
+                    if x >= n - backward[reverse_offset]:
+                        return x, y
+        for k in range(-d + backward_start, d + 1 - backward_end, 2):
+            k_offset = offset + k
+            if k == -d or (k != d and backward[k_offset - 1] < backward[k_offset + 1]):
+                x = backward[k_offset + 1]
+            else:
+                x = backward[k_offset - 1] + 1
+            y = x - k
+            while x < n and y < m and a[ahi - x - 1] == b[bhi - y - 1]:
+                x += 1
+                y += 1
+            backward[k_offset] = x
+            if x > n:
+                backward_end += 2
+            elif y > m:
+                backward_start += 2
+            elif not odd:
+                forward_offset = offset + delta - k
+                if 0 <= forward_offset < len(forward) and forward[forward_offset] != -1:
+                    forward_x = forward[forward_offset]
+                    if forward_x >= n - x:
+                        return forward_x, forward_x - (delta - k)
+    return None
+
+
+def myers_matching_blocks(a, b):
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        prefix = common_prefix(a, alo, ahi, b, blo, bhi)
+        if prefix:
+            blocks.append((alo, blo, prefix))
+            alo += prefix
+            blo += prefix
+        suffix = common_suffix(a, alo, ahi, b, blo, bhi)
+        if suffix:
+            blocks.append((ahi - suffix, bhi - suffix, suffix))
+            ahi -= suffix
+            bhi -= suffix
+        if alo == ahi or blo == bhi:
+            continue
+        split = middle_snake(a, alo, ahi, b, blo, bhi)
+        if split is None:
+            continue
+        x, y = split
+        stack.append((alo + x, ahi, blo + y, bhi))
+        stack.append((alo, alo + x, blo, blo + y))
+    blocks.sort()
+
+    merged = []
+    for i, j, size in blocks:
+        if (
+            merged
+            and merged[-1][0] + merged[-1][2] == i
+            and merged[-1][1] + merged[-1][2] == j
+        ):
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + size)
+        else:
+            merged.append((i, j, size))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+
+def blocks_to_opcodes(blocks):
+    # same conversion as SequenceMatcher.get_opcodes
+    i = j = 0
+    opcodes = []
+    for ai, bj, size in blocks:
+        tag = ""
+        if i < ai and j < bj:
+            tag = "replace"
+        elif i < ai:
+            tag = "delete"
+        elif j < bj:
+            tag = "insert"
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(("equal", ai, i, bj, j))
+    return opcodes
+
+
+class MyersMatcher:
+    name = "myers"
+    version = 1
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+        self.matching_blocks = None
+        self.opcodes = None
+
+    def get_matching_blocks(self):
+        if self.matching_blocks is None:
+            ids_a, ids_b = to_ids(self.a, self.b)
+            self.matching_blocks = myers_matching_blocks(ids_a, ids_b)
+        return self.matching_blocks
+
+    def get_opcodes(self):
+        if self.opcodes is None:
+            self.opcodes = blocks_to_opcodes(self.get_matching_blocks())
+        return self.opcodes
+
+
+def append_opcode(opcodes, opcode):
+    tag, i1, i2, j1, j2 = opcode
+    if opcodes and opcodes[-1][0] == tag:
+        prev_tag, prev_i1, prev_i2, prev_j1, prev_j2 = opcodes[-1]
+        if prev_i2 == i1 and prev_j2 == j1:
+            opcodes[-1] = (tag, prev_i1, i2, prev_j1, j2)
+            return
+    opcodes.append(opcode)
+
+
+def opcodes_to_blocks(opcodes, len_a, len_b):
+    blocks = [(i1, j1, i2 - i1) for tag, i1, i2, j1, j2 in opcodes if tag == "equal"]
+    blocks.append((len_a, len_b, 0))
+    return blocks
+
+
+class DiffBudget:
+    # caps the work spent diffing for one request: windows with more than
+    # max_tokens changed items, or any left once the deadline has passed,
+    # are reported as replaced wholesale instead of being matched
+    def __init__(self, max_tokens=None, seconds=None):
+        if max_tokens is None:
+            max_tokens = app.config["DIFF_BUDGET_TOKENS"]
+        if seconds is None:
+            seconds = app.config["DIFF_BUDGET_SECONDS"]
+        self.max_tokens = max_tokens
+        self.deadline = time.monotonic() + seconds
+        self.fallbacks = 0
+
+    def remaining(self):
+        return max(0, self.deadline - time.monotonic())
+
+    def allows(self, size):
+        if size <= self.max_tokens and time.monotonic() < self.deadline:
+            return True
+        self.fallbacks += 1
+        return False
+
+
+class BlockMatcher:
+    # two level diff: blocks (given as lists of boundary offsets into each
+    # sequence) are aligned as whole units first, and the items are only
+    # matched inside runs of blocks that were replaced
+    def __init__(self, a, b, bounds_a, bounds_b, engine=None, budget=None):
+        self.a = a
+        self.b = b
+        self.bounds_a = bounds_a
+        self.bounds_b = bounds_b
+        self.engine = engine
+        self.budget = budget
+        self.opcodes = None
+
+    def get_opcodes(self):
+        if self.opcodes is None:
+            blocks_a = [
+                tuple(self.a[i:j]) for i, j in zip(self.bounds_a, self.bounds_a[1:])
+            ]
+            blocks_b = [
+                tuple(self.b[i:j]) for i, j in zip(self.bounds_b, self.bounds_b[1:])
+            ]
+            opcodes = []
+            block_matcher = get_matcher(blocks_a, blocks_b, self.engine, self.budget)
+            for tag, i1, i2, j1, j2 in block_matcher.get_opcodes():
+                alo, ahi = self.bounds_a[i1], self.bounds_a[i2]
+                blo, bhi = self.bounds_b[j1], self.bounds_b[j2]
+                if tag != "replace":
+                    append_opcode(opcodes, (tag, alo, ahi, blo, bhi))
+                    continue
+                matcher = get_matcher(
+                    self.a[alo:ahi], self.b[blo:bhi], self.engine, self.budget
+                )
+                for tag, k1, k2, l1, l2 in matcher.get_opcodes():
+                    append_opcode(
+                        opcodes, (tag, alo + k1, alo + k2, blo + l1, blo + l2)
+                    )
+            self.opcodes = opcodes
+        return self.opcodes
+
+    def get_matching_blocks(self):
+        return opcodes_to_blocks(self.get_opcodes(), len(self.a), len(self.b))
+
+
+engines = {matcher.name: matcher for matcher in [DifflibMatcher, MyersMatcher]}
+assert sorted(engines) == sorted(diff_engines)
+
+
+def get_engine(name=None):
+    if name is None:
+        name = app.config["DIFF_ENGINE"]
+    return engines[name]
+
+
+class TrimmedMatcher:
+    # maps both sequences to ids from a shared vocabulary, strips their
+    # common prefix and suffix, and only hands the middle to the engine
+    def __init__(self, a, b, engine=None, budget=None):
+        self.a = a
+        self.b = b
+        self.engine = get_engine(engine)
+        self.budget = budget
+        self.opcodes = None
+
+    def get_opcodes(self):
+        if self.opcodes is None:
+            ids_a, ids_b = to_ids(self.a, self.b)
+            prefix = prefix_length(ids_a, ids_b)
+            suffix = suffix_length(ids_a, ids_b, prefix)
+            ahi = len(ids_a) - suffix
+            bhi = len(ids_b) - suffix
+            opcodes = []
+            if prefix:
+                opcodes.append(("equal", 0, prefix, 0, prefix))
+            if (
+                prefix < ahi
+                and prefix < bhi
+                and self.budget is not None
+                and not self.budget.allows(ahi + bhi - 2 * prefix)
+            ):
+                opcodes.append(("replace", prefix, ahi, prefix, bhi))
+            elif prefix < ahi or prefix < bhi:
+                matcher = self.engine(ids_a[prefix:ahi], ids_b[prefix:bhi])
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                    append_opcode(
+                        opcodes,
+                        (tag, prefix + i1, prefix + i2, prefix + j1, prefix + j2),
+                    )
+            if suffix:
+                append_opcode(opcodes, ("equal", ahi, len(ids_a), bhi, len(ids_b)))
+            self.opcodes = opcodes
+        return self.opcodes
+
+    def get_matching_blocks(self):
+        return opcodes_to_blocks(self.get_opcodes(), len(self.a), len(self.b))
+
+
+def get_matcher(sequence_a, sequence_b, engine=None, budget=None):
+    return TrimmedMatcher(sequence_a, sequence_b, engine, budget)
@@ -0,0 +1,76 @@
+from datetime import timedelta
+from pymodm import fields, MongoModel
+from pymodm.errors import DoesNotExist
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from pymongo.operations import IndexModel
+
+from .app import app, timestamp
+from .cache import content_hash
+from .diff import get_engine
+from .html_utils import markup_changes, markup_version
+from .offload import offload_markup_changes
+
+
+class DiffMemo(MongoModel):
+    hash_a = fields.CharField()
+    hash_b = fields.CharField()
+    concise = fields.BooleanField()
+    engine = fields.CharField()
+    body_diff = fields.CharField(blank=True)
+    expires = fields.DateTimeField()
+
+    class Meta:
+        indexes = [
+            IndexModel(
+                [
+                    ("hash_a", ASCENDING),
+                    ("hash_b", ASCENDING),
+                    ("concise", ASCENDING),
+                    ("engine", ASCENDING),
+                ],
+                unique=True,
+            ),
+            # the TTL is kept on each memo rather than in the index, whose options
+            # can't be changed by recreating it with another DIFF_MEMO_TTL
+            IndexModel("expires", expireAfterSeconds=0),
+        ]
+
+
+def engine_key():
+    # stored diffs are only reusable if they were produced by the same
+    # matcher and rendering code, so both versions are part of the key
+    engine = get_engine()
+    return "{}-{}-{}-{}".format(
+        engine.name,
+        engine.version,
+        markup_version,
+        app.config["DIFF_BLOCK_MIN_TOKENS"],
+    )
+
+
+def memo_markup_changes(data_a, data_b, concise=False, budget=None):
+    if len(data_a) + len(data_b) < app.config["DIFF_MEMO_MIN_LENGTH"]:
+        return markup_changes(data_a, data_b, concise=concise, budget=budget)
+    key = dict(
+        hash_a=content_hash(data_a),
+        hash_b=content_hash(data_b),
+        concise=concise,
+        engine=engine_key(),
+    )
+    try:
+        return DiffMemo.objects.raw(key).only("body_diff").first().body_diff
+    except DoesNotExist:
+        pass
+    fallbacks = budget.fallbacks if budget is not None else 0
+    body_diff = offload_markup_changes(data_a, data_b, concise=concise, budget=budget)
+    if budget is not None and budget.fallbacks > fallbacks:
+        # a coarse diff is only good enough for the request that ran out
+        return body_diff
+    try:
+        expires = timestamp() + timedelta(seconds=app.config["DIFF_MEMO_TTL"])
+        DiffMemo(body_diff=body_diff, expires=expires, **key).save()
+    except DuplicateKeyError:
+        # another worker diffed the same pair in the meantime
+        pass
+    return body_diff
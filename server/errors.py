@@ -48,3 +48,7 @@ class IncorrectPassword(UserError):
 
 class Malformed(UserError):
     pass
+
+
+class MergeTimeout(UserError):
+    pass
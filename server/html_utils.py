@@ -1,17 +1,23 @@
 import bleach
 import re
-import itertools
+import string
+from ast import literal_eval
+from html import unescape
+from html.entities import html5 as entities
 from html.parser import HTMLParser
-from difflib import SequenceMatcher
 import urllib
 from urllib.parse import urlparse
 import os
 
+from .app import app
+from .cache import LRUCache, content_hash
+from .diff import BlockMatcher, get_matcher
 from .errors import *
 
 
 self_closing = ["br", "img"]
 header_tags = ["h{}".format(x) for x in range(2, 7)]
+block_tags = ["div", "p", "li", "ol", "ul"] + header_tags
 whitespace = " \t\n\xa0"
 wordbreak = ".,?!/-–—"
 allowed_tags = [
@@ -32,14 +38,6 @@ allowed_attrs = {"a": ["href", "title"], "img": ["src"]}
 img_exts = [".png", ".jpg", ".jpeg", ".gif"]
 
 
-def char_type(c):
-    if c in whitespace:
-        return 0
-    if c in wordbreak:
-        return 1
-    return 2
-
-
 def name_to_title(name):
     return name.replace(" ", "_").replace("/", "|")
 
@@ -55,65 +53,185 @@ def get_thread_title(href):
     return urllib.parse.unquote(match.group(2))
 
 
-def linkify(html):
-    links = set()
+thread_link_re = re.compile(r"thread.wiki/page/([^/\s\"'<>]+)")
+
+
+def find_thread_titles(html):
+    # a superset of the titles linkify will look up, so they can be resolved
+    # in one query up front
+    titles = set()
+    for title in thread_link_re.findall(html):
+        title = urllib.parse.unquote(title)
+        titles.add(title)
+        titles.add(title.rstrip(".,;:!?)"))
+    return titles
+
+
+def find_name(thread_title, names):
+    # names maps titles to page names, or to None for pages that don't exist;
+    # titles missing from it are looked up one at a time
     from .page import Page
 
+    if thread_title in names:
+        return names[thread_title]
+    try:
+        return Page.find(thread_title).name
+    except PageNotFound:
+        return None
+
+
+def link_text(href, names, links):
+    # the text a link to href is shown with, noting links to other pages
+    thread_title = get_thread_title(href)
+    if thread_title is None:
+        _fnm, ext = os.path.splitext(urlparse(href).path)
+        if ext.lower() in img_exts:
+            return sanitize_html("<img src='{}'>".format(href))
+        return sanitize_text(href)
+    name = find_name(thread_title, names)
+    if name is None:
+        name = title_to_name(thread_title)
+    text = sanitize_text(name)
+    links.add(thread_title)
+    return text
+
+
+url_re = bleach.linkifier.build_url_re(tlds=["[a-z]+"])
+proto_re = bleach.linkifier.PROTO_RE
+
+
+def bleach_linkify(html, names=None):
+    links = set()
+    if names is None:
+        names = {}
+
     def clean_link(attrs, new=False):
         if (None, "href") not in attrs:
             return None
-        href = attrs[(None, "href")]
-        thread_title = get_thread_title(href)
-        if thread_title is None:
-            _fnm, ext = os.path.splitext(urlparse(href).path)
-            if ext.lower() in img_exts:
-                attrs["_text"] = sanitize_html("<img src='{}'>".format(href))
-            else:
-                attrs["_text"] = sanitize_text(href)
-        else:
-            try:
-                # TODO: improve performance here
-                page = Page.find(thread_title)
-                attrs["_text"] = sanitize_text(page.name)
-            except PageNotFound:
-                attrs["_text"] = sanitize_text(title_to_name(thread_title))
-            links.add(thread_title)
+        attrs["_text"] = link_text(attrs[(None, "href")], names, links)
         return attrs
 
-    linker = bleach.Linker(
-        callbacks=[clean_link], url_re=bleach.linkifier.build_url_re(tlds=["[a-z]+"])
-    )
+    linker = bleach.Linker(callbacks=[clean_link], url_re=url_re)
     return links, normalize(linker.linkify(html))
 
 
-def linkify_page(sections, summary):
-    links, summary = linkify(summary)
-    for section in sections:
-        section_links, section.body = linkify(section.body)
+def linkify(html, names=None):
+    parser = PageSequencer(names, sanitize=False)
+    try:
+        parser.feed(html)
+        parser.close()
+    except UnsupportedMarkup:
+        return bleach_linkify(html, names)
+    return parser.links, generate_html(parser.sequence)
+
+
+# the href of a link as generate_html writes it, sorted first and quoted by repr
+written_href_re = re.compile(r"""<a href=('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+
+def find_links(html):
+    # the pages linked to from markup linkify already wrote
+    links = set()
+    for match in written_href_re.finditer(html):
+        thread_title = get_thread_title(literal_eval(match.group(1)))
+        if thread_title is not None:
+            links.add(thread_title)
+    return links
+
+
+def linkify_page(sections, summary, names=None, previous=None):
+    # sections and a summary that come back as they were in the previous
+    # version were linkified when it was saved, so its copies are kept
+    from .page import Page
+    from .sections import Section
+
+    unchanged = [None] * len(sections)
+    if previous is not None:
+        stored = {
+            (section.heading, section.level, section.body_hash): section
+            for section in previous.sections
+        }
+        unchanged = [
+            stored.get((section.heading, section.level, content_hash(section.body)))
+            for section in sections
+        ]
+    keep_summary = previous is not None and summary == previous.summary
+    if names is None:
+        titles = set() if keep_summary else find_thread_titles(summary)
+        for section, kept in zip(sections, unchanged):
+            if kept is None:
+                titles |= find_thread_titles(section.body)
+        found = Page.find_names(titles) if titles else {}
+        names = {title: found.get(title) for title in titles}
+    if keep_summary:
+        links = find_links(summary)
+    else:
+        links, summary = linkify(summary, names)
+    linked_sections = []
+    for section, kept in zip(sections, unchanged):
+        if kept is not None:
+            links = links.union(find_links(kept.body))
+            linked_sections.append(kept)
+            continue
+        section_links, body = linkify(section.body, names)
         links = links.union(section_links)
-    return links, sections, summary
+        linked_sections.append(
+            Section(heading=section.heading, level=section.level, body=body)
+        )
+    return links, linked_sections, summary
+
+
+def clean_page(html, names=None, previous=None):
+    # what sanitize_html, separate_sections and linkify_page make of an edited
+    # page, without writing out the sanitized markup and parsing it again
+    from .sections import separate_sections, separate_sequence
+
+    parser = PageSequencer()
+    try:
+        parser.feed(html)
+        parser.close()
+    except UnsupportedMarkup:
+        summary, sections = separate_sections(
+            bleach_clean(html, allowed_tags + header_tags)
+        )
+    else:
+        summary, sections = separate_sequence(parser.sequence)
+    return linkify_page(sections, summary, names, previous)
 
 
 def normalize(data):
     return generate_html(get_sequence(data))
 
 
+def bleach_clean(html, tags):
+    return bleach.clean(html, tags=tags, attributes=allowed_attrs, strip=True)
+
+
+def sanitize(html, tags):
+    # what bleach_clean writes, without html5lib where HTMLSanitizer can follow
+    # the markup
+    html = str(html)
+    parser = HTMLSanitizer(tags)
+    try:
+        parser.feed(html)
+        parser.close()
+    except UnsupportedMarkup:
+        return bleach_clean(html, tags)
+    return parser.getvalue()
+
+
 def sanitize_html(html):
-    return bleach.clean(
-        str(html), tags=allowed_tags + header_tags, attributes=allowed_attrs, strip=True
-    )
+    return sanitize(html, allowed_tags + header_tags)
 
 
 def sanitize_paragraph(html):
-    return bleach.clean(
-        str(html), tags=allowed_tags, attributes=allowed_attrs, strip=True
-    )
+    return sanitize(html, allowed_tags)
 
 
 def sanitize_text(text):
     if text == "":
         raise EmptyString()
-    return bleach.clean(str(text), tags=[], strip=True)
+    return sanitize(text, [])
 
 
 def splitstrip(s):
@@ -128,50 +246,69 @@ def is_word(s):
     return len(s.strip(whitespace)) > 0
 
 
+word_re = re.compile(
+    "[{0}]+|[{1}]+|[^{0}{1}]+".format(re.escape(whitespace), re.escape(wordbreak))
+)
+
+
 def split_words(data):
-    words = []
-    for _, group in itertools.groupby(data, char_type):
-        words.append("".join(group))
-    return words
+    return word_re.findall(data)
 
 
-def immutify(data):
-    if isinstance(data, tuple) or isinstance(data, list):
-        return tuple(immutify(x) for x in data)
-    else:
-        return data
+set_slot = object.__setattr__
 
 
 class Token:
+    # tokens are compared and hashed constantly by the matchers, so the
+    # identity and its hash are computed once and the instances stay small.
+    # they are also shared between cached sequences, so they are immutable:
+    # use with_context/with_data to get a modified copy
+    __slots__ = ("identity", "_hash")
+
     def __init__(self, identity):
-        self.identity = immutify(identity)
+        set_slot(self, "identity", identity)
+        set_slot(self, "_hash", hash(identity))
 
-    def mark_dirty(self):
-        self.identity = (self.identity, True)
+    def __setattr__(self, name, value):
+        raise AttributeError("tokens are immutable")
 
     def __eq__(self, other):
-        return self.identity == other.identity
+        return self._hash == other._hash and self.identity == other.identity
 
     def __hash__(self):
-        return hash(self.identity)
+        return self._hash
 
 
 class DataToken(Token):
+    __slots__ = ("data", "context")
+
     def __init__(self, data, context):
         super().__init__((data, context))
-        self.data = data
-        self.context = context
+        set_slot(self, "data", data)
+        set_slot(self, "context", context)
+
+    def with_context(self, context):
+        return DataToken(self.data, context)
+
+    def with_data(self, data):
+        return DataToken(data, self.context)
 
     def __repr__(self):
         return "{}({})".format(repr(self.data), ",".join(t for t, a in self.context))
 
 
 class TagToken(Token):
+    __slots__ = ("tag", "context", "attrs")
+
     def __init__(self, tag, context, attrs):
+        attrs = tuple(attrs)
         super().__init__((tag, context, attrs))
-        self.tag = tag
-        self.context = context
-        self.attrs = attrs
+        set_slot(self, "tag", tag)
+        set_slot(self, "context", context)
+        set_slot(self, "attrs", attrs)
+
+    def with_context(self, context):
+        return TagToken(self.tag, context, self.attrs)
 
     def __repr__(self):
         return "<{}>({})".format(self.tag, ",".join(t for t, a in self.context))
@@ -181,39 +318,696 @@ class HTMLSequencer(HTMLParser):
     def __init__(self):
         super().__init__(convert_charrefs=False)
 
-        self.context = []
+        # contexts are tuples of (tag, attrs) pairs shared by every token
+        # inside the same element, interned so that equal contexts are the
+        # same object and compare by identity
+        self.context = ()
+        self.context_stack = []
+        self.contexts = {(): ()}
         self.sequence = []
 
         self.just_closed = None
 
+    def intern_context(self, context):
+        return self.contexts.setdefault(context, context)
+
     def handle_entityref(self, name):
-        self.sequence.append(DataToken("&{};".format(name), self.context.copy()))
+        self.sequence.append(DataToken("&{};".format(name), self.context))
 
     def handle_charref(self, name):
-        self.sequence.append(DataToken("&#{};".format(name), self.context.copy()))
+        self.sequence.append(DataToken("&#{};".format(name), self.context))
 
     def handle_starttag(self, tag, attrs):
+        attrs = tuple(attrs)
         if tag in self_closing:
-            self.sequence.append(TagToken(tag, self.context.copy(), attrs))
+            self.sequence.append(TagToken(tag, self.context, attrs))
         else:
             if (tag, attrs) == self.just_closed:
-                self.sequence.append(DataToken("", self.context.copy()))
+                self.sequence.append(DataToken("", self.context))
             else:
                 self.just_closed = None
-            self.context.append((tag, attrs))
+            self.context_stack.append(self.context)
+            self.context = self.intern_context(self.context + ((tag, attrs),))
 
     def handle_endtag(self, end_tag):
         if not self.context:
             print("Warning: mismatched tag `{}`".format(end_tag))
-        start_tag, attrs = self.context.pop()
+        start_tag, attrs = self.context[-1]
+        self.context = self.context_stack.pop()
         if start_tag != end_tag:
             print("Warning: mismatched tag `{}`".format(end_tag))
         self.just_closed = (start_tag, attrs)
 
     def handle_data(self, data):
-        words = split_words(data)
-        for word in words:
-            self.sequence.append(DataToken(word, self.context.copy()))
+        context = self.context
+        self.sequence.extend(DataToken(word, context) for word in split_words(data))
+
+
+class UnsupportedMarkup(Exception):
+    pass
+
+
+# character references, the way html5lib reads them and the way bleach
+# decides which to leave alone
+
+entity_prefixes = {name[:i] for name in entities for i in range(len(name) + 1)}
+entity_end = "<&=;" + " \t\n\r\x0b\x0c"
+ascii_alnum = frozenset(string.ascii_letters + string.digits)
+# numeric references html5 maps to other characters, mostly windows-1252
+replaced_charrefs = {
+    code_point: bytes([code_point]).decode("cp1252", "ignore") or chr(code_point)
+    for code_point in range(0x80, 0xA0)
+}
+replaced_charrefs.update({0x00: "\ufffd", 0x0D: "\r"})
+charref_re = re.compile("&(?:#[xX]([0-9a-fA-F]+);?|#([0-9]+);?|([a-zA-Z0-9]+;?))")
+
+
+def decode_charref(match, data, attribute):
+    hex_digits, digits, name = match.groups()
+    if name is None:
+        code_point = int(hex_digits, 16) if digits is None else int(digits)
+        if code_point in replaced_charrefs:
+            return replaced_charrefs[code_point]
+        if 0xD800 <= code_point <= 0xDFFF or code_point > 0x10FFFF:
+            return "\ufffd"
+        return chr(code_point)
+    rest = ""
+    if name.endswith(";"):
+        if name in entities:
+            return entities[name]
+        name, rest = name[:-1], ";"
+    # the longest entity without a ";" the name starts with
+    for length in range(len(name), 1, -1):
+        if name[:length] in entities:
+            break
+    else:
+        return match.group()
+    after = name[length : length + 1] or rest or data[match.end() : match.end() + 1]
+    if attribute and (after in ascii_alnum or after == "="):
+        return match.group()
+    return entities[name[:length]] + name[length:] + rest
+
+
+def decode_charrefs(data, attribute=False):
+    if "&" not in data:
+        return data
+    return charref_re.sub(lambda match: decode_charref(match, data, attribute), data)
+
+
+def match_entity(data):
+    # the entity data starts with, right after its "&", if it ends with ";"
+    i = 0
+    entity = ""
+    if data.startswith("#"):
+        entity = "#"
+        i = 1
+        digits = "0123456789"
+        if data[1:2] in ("x", "X"):
+            entity += data[1]
+            i = 2
+            digits += "abcdefABCDEF"
+        while i < len(data) and data[i] not in entity_end:
+            i += 1
+            if data[i - 1] not in digits:
+                break
+            entity += data[i - 1]
+    else:
+        while i < len(data) and data[i] not in entity_end:
+            i += 1
+            if entity not in entity_prefixes:
+                break
+            entity += data[i - 1]
+    if entity and data[i : i + 1] == ";":
+        return entity
+    return None
+
+
+def convert_entity(entity):
+    if entity[0] != "#":
+        return entities.get(entity)
+    if entity[1:2] in ("x", "X"):
+        digits, base = entity[2:], 16
+    else:
+        digits, base = entity[1:], 10
+    if digits == "":
+        return None
+    code_point = int(digits, base)
+    if 0 < code_point < 0x110000:
+        return chr(code_point)
+    return None
+
+
+def escape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def clean_text(data):
+    # a text node as bleach.clean writes it: entities closed by ";" stay,
+    # other ampersands are escaped
+    parts = data.split("&")
+    cleaned = [escape(parts[0])]
+    for part in parts[1:]:
+        entity = match_entity(part)
+        if entity is None:
+            cleaned.append("&amp;" + escape(part))
+        else:
+            cleaned.append("&amp;" if entity == "amp" else "&{};".format(entity))
+            cleaned.append(escape(part[len(entity) + 1 :]))
+    return "".join(cleaned)
+
+
+def write_attr(value, escape_lt=False):
+    # an attribute value as bleach writes it, quotes included
+    value = value.replace("&", "&amp;")
+    if escape_lt:
+        value = value.replace("<", "&lt;")
+    if '"' in value and "'" not in value:
+        # single quoted, which bleach leaves alone
+        return "'{}'".format(value)
+    value = value.replace('"', "&quot;")
+    parts = value.replace("&amp;", "&").split("&")
+    written = [parts[0]]
+    for part in parts[1:]:
+        entity = match_entity(part)
+        if entity is not None and convert_entity(entity) is not None:
+            written.append("&{};{}".format(entity, part[len(entity) + 1 :]))
+        else:
+            written.append("&amp;" + part)
+    return '"{}"'.format("".join(written))
+
+
+def clean_attr(value, escape_lt=False):
+    # an attribute value as bleach writes it, read back by HTMLParser
+    written = write_attr(value, escape_lt)
+    if written.startswith("'"):
+        return value
+    return unescape(written[1:-1])
+
+
+allowed_protocols = ["http", "https", "mailto"]
+uri_junk_re = re.compile(r"[`\000-\040\177-\240\s]+")
+
+
+def convert_entities(value):
+    parts = value.split("&")
+    converted = [parts[0]]
+    for part in parts[1:]:
+        entity = match_entity(part)
+        char = None if entity is None else convert_entity(entity)
+        if char is None:
+            converted.append("&" + part)
+        else:
+            converted.append(char + part[len(entity) + 1 :])
+    return "".join(converted)
+
+
+def allowed_uri(value):
+    value = uri_junk_re.sub("", convert_entities(value))
+    value = value.replace("\ufffd", "").lower()
+    try:
+        scheme = urlparse(value).scheme
+    except ValueError:
+        return False
+    if scheme:
+        return scheme in allowed_protocols
+    return True
+
+
+def strip_non_url_bits(url):
+    # parentheses and punctuation url_re picks up around a url
+    prefix = suffix = ""
+    while url:
+        if url.startswith("("):
+            prefix += "("
+            url = url[1:]
+            if url.endswith(")"):
+                suffix = ")" + suffix
+                url = url[:-1]
+        elif url.endswith(")") and "(" not in url:
+            suffix = ")" + suffix
+            url = url[:-1]
+        elif url.endswith(",") or url.endswith("."):
+            suffix = url[-1] + suffix
+            url = url[:-1]
+        else:
+            break
+    return url, prefix, suffix
+
+
+# how html5 parsers build the tree for the tags pages are written with; the
+# sets name the categories of the html5 tree construction rules. bleach drops
+# the tags it strips before html5lib builds the tree, so only kept tags ever
+# become elements
+
+formatting_tags = {
+    "a",
+    "b",
+    "big",
+    "code",
+    "em",
+    "font",
+    "i",
+    "s",
+    "small",
+    "strike",
+    "strong",
+    "tt",
+    "u",
+}
+heading_tags = set(header_tags)
+p_closing_tags = {"div", "ol", "p", "ul"}
+special_tags = p_closing_tags | heading_tags | {"br", "img", "li"}
+implied_end_tags = {"p", "li"}
+
+# stands in for & while HTMLParser reads the markup, so it leaves character
+# references alone. it's a private use character, and markup with one falls back
+amp_marker = "\ue000"
+unsupported_re = re.compile(
+    r"[\x00-\x08\x0b-\x1f{}]|<!---?>|--\s+>|--!>".format(amp_marker)
+)
+end_tag_re = re.compile(r"</(?![a-zA-Z][a-zA-Z0-9]*[ \t\n\x0c]*>)")
+tag_in_text_re = re.compile("<[a-zA-Z!/?]")
+start_tag_re = re.compile(
+    r"""<[a-zA-Z][a-zA-Z0-9]*"""
+    r"""(?:[ \t\n\x0c]+[a-zA-Z_:][-a-zA-Z0-9_:.]*"""
+    r"""(?:[ \t\n\x0c]*=[ \t\n\x0c]*(?:"[^"]*"|'[^']*'|[^ \t\n\x0c"'=<>`]+))?)*"""
+    r"""[ \t\n\x0c]*/?>"""
+)
+
+
+class Element:
+    # raw_attrs are the attributes as written, which html5 compares formatting
+    # elements by
+    __slots__ = ("tag", "attrs", "raw_attrs")
+
+    def __init__(self, tag, attrs, raw_attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.raw_attrs = raw_attrs
+
+
+class PageSequencer(HTMLSequencer):
+    # sanitizes and linkifies while building the sequence, with the same result
+    # as bleach.clean and bleach.Linker, which parse with html5lib, followed by
+    # separate_sections and normalize. the open elements and the formatting
+    # elements to reopen are kept by the html5 rules, so markup is restructured
+    # the same way, but only for the tags and constructs pages are written
+    # with: anything else raises UnsupportedMarkup for the caller to hand to
+    # bleach instead. without sanitize, the markup is our own and only linkified
+    CDATA_CONTENT_ELEMENTS = ()
+
+    def __init__(self, names=None, sanitize=True, tags=None):
+        super().__init__()
+        self.names = {} if names is None else names
+        self.sanitize = sanitize
+        if tags is None:
+            tags = allowed_tags + header_tags if sanitize else allowed_tags
+        self.kept_tags = tags
+        self.links = set()
+
+        self.open_elements = []
+        self.formatting = []
+
+        # the text node being parsed, and the text since the last kept tag
+        self.raw = []
+        self.text = []
+
+        # links are rewritten once their text is known, so everything inside
+        # one is held back until it closes
+        self.anchor = None
+        self.anchor_text = []
+        self.anchor_events = []
+
+    def feed(self, data):
+        if unsupported_re.search(data) or end_tag_re.search(data):
+            raise UnsupportedMarkup()
+        # character references are decoded here rather than by HTMLParser
+        super().feed(data.replace("&", amp_marker))
+
+    def close(self):
+        if "<" in self.rawdata:
+            # an unfinished tag or comment, which HTMLParser reads as text
+            raise UnsupportedMarkup()
+        super().close()
+        while self.open_elements:
+            self.pop()
+        self.flush()
+
+    # text
+
+    def handle_data(self, data):
+        self.reconstruct_formatting()
+        self.raw.append(data)
+
+    def end_text_node(self):
+        if not self.raw:
+            return
+        data = "".join(self.raw).replace(amp_marker, "&")
+        self.raw = []
+        if "<" in data and tag_in_text_re.search(data):
+            raise UnsupportedMarkup()
+        if self.sanitize:
+            self.text.append(clean_text(data))
+        else:
+            self.text.append(decode_charrefs(data))
+
+    def flush(self):
+        self.end_text_node()
+        if not self.text:
+            return
+        text = "".join(self.text)
+        self.text = []
+        if self.sanitize:
+            self.emit_text(text)
+        elif self.anchor is not None:
+            self.anchor_text.append(text)
+            self.anchor_events.append(("text", text))
+        else:
+            self.add_links(text)
+
+    def add_links(self, text):
+        end = 0
+        for match in url_re.finditer(text):
+            self.add_text(text[end : match.start()])
+            url, prefix, suffix = strip_non_url_bits(match.group())
+            href = url if proto_re.search(url) else "http://" + url
+            self.add_text(prefix)
+            self.start_tag("a", [("href", clean_attr(href))])
+            self.add_text(link_text(href, self.names, self.links))
+            self.end_tag("a")
+            self.add_text(suffix)
+            end = match.end()
+        self.add_text(text[end:])
+
+    def add_text(self, text):
+        if text:
+            self.emit_text(escape(text))
+
+    def emit_text(self, text):
+        # the sequence is only written out again, so text isn't split into words
+        self.sequence.append(DataToken(text, self.context))
+
+    def start_tag(self, tag, attrs):
+        HTMLSequencer.handle_starttag(self, tag, attrs)
+
+    def end_tag(self, tag):
+        HTMLSequencer.handle_endtag(self, tag)
+
+    def handle_comment(self, data):
+        self.end_text_node()
+
+    def handle_decl(self, decl):
+        raise UnsupportedMarkup()
+
+    def handle_pi(self, data):
+        raise UnsupportedMarkup()
+
+    def unknown_decl(self, data):
+        raise UnsupportedMarkup()
+
+    # elements
+
+    def get_attrs(self, tag, attrs):
+        cleaned = []
+        for name, value in attrs:
+            if self.sanitize:
+                if name not in allowed_attrs.get(tag, []):
+                    continue
+                if name in ["href", "src"] and not allowed_uri(value):
+                    continue
+            cleaned.append((name, value))
+        if self.sanitize or tag == "a":
+            cleaned.sort()
+        return cleaned
+
+    def output_attrs(self, attrs):
+        # as the sanitized or linkified markup reads back
+        if not self.sanitize:
+            return [
+                (name, clean_attr(decode_charrefs(value, attribute=True)))
+                for name, value in attrs
+            ]
+        cleaned = []
+        for name, value in attrs:
+            value = clean_attr(value, escape_lt=True)
+            if repr(value)[1:-1] != value:
+                # generate_html would write it with escapes html doesn't have
+                raise UnsupportedMarkup()
+            cleaned.append((name, value))
+        return cleaned
+
+    def insert(self, tag, attrs, raw_attrs=()):
+        self.end_text_node()
+        element = Element(tag, attrs, raw_attrs)
+        if tag not in self_closing:
+            self.open_elements.append(element)
+        self.emit_start(element)
+        return element
+
+    def emit_start(self, element):
+        self.flush()
+        if element.tag == "a" and not self.sanitize:
+            self.anchor = element
+            return
+        event = ("start", element.tag, self.output_attrs(element.attrs))
+        if self.anchor is not None:
+            self.anchor_events.append(event)
+        else:
+            self.start_tag(*event[1:])
+
+    def pop(self):
+        element = self.open_elements.pop()
+        self.flush()
+        if element is self.anchor:
+            self.close_anchor()
+            return element
+        if self.anchor is not None:
+            self.anchor_events.append(("end", element.tag))
+        else:
+            self.end_tag(element.tag)
+        return element
+
+    def close_anchor(self):
+        attrs = dict(
+            (name, decode_charrefs(value, attribute=True))
+            for name, value in self.anchor.attrs
+        )
+        text = "".join(self.anchor_text)
+        events = self.anchor_events
+        self.anchor = None
+        self.anchor_text = []
+        self.anchor_events = []
+        if "href" not in attrs:
+            self.add_text(text)
+            return
+        new_text = link_text(attrs["href"], self.names, self.links)
+        attrs = [(name, clean_attr(value)) for name, value in sorted(attrs.items())]
+        self.start_tag("a", attrs)
+        if new_text != text:
+            self.add_text(new_text)
+        else:
+            for event, *args in events:
+                if event == "start":
+                    self.start_tag(*args)
+                elif event == "end":
+                    self.end_tag(*args)
+                else:
+                    self.add_text(*args)
+        self.end_tag("a")
+
+    def pop_until(self, element):
+        while self.pop() is not element:
+            pass
+
+    def generate_implied_end_tags(self, exclude=None):
+        while (
+            self.open_elements
+            and self.open_elements[-1].tag in implied_end_tags
+            and self.open_elements[-1].tag != exclude
+        ):
+            self.pop()
+
+    def find_open(self, tags, boundary=()):
+        for element in reversed(self.open_elements):
+            if element.tag in tags:
+                return element
+            if element.tag in boundary:
+                return None
+        return None
+
+    def close_p(self):
+        p = self.find_open(["p"])
+        if p is not None:
+            self.generate_implied_end_tags(exclude="p")
+            self.pop_until(p)
+
+    def reconstruct_formatting(self):
+        # formatting elements closed by something else are reopened before
+        # the next text or inline element
+        if not self.formatting or self.formatting[-1] in self.open_elements:
+            return
+        i = len(self.formatting) - 1
+        while i > 0 and self.formatting[i - 1] not in self.open_elements:
+            i -= 1
+        for j in range(i, len(self.formatting)):
+            element = self.formatting[j]
+            if element.tag == "a":
+                raise UnsupportedMarkup()
+            self.formatting[j] = self.insert(
+                element.tag, element.attrs, element.raw_attrs
+            )
+
+    def skip_tag(self):
+        if not self.sanitize:
+            raise UnsupportedMarkup()
+        # a stripped tag is left as empty text, which still reopens formatting
+        self.reconstruct_formatting()
+
+    def handle_starttag(self, tag, attrs):
+        if not start_tag_re.fullmatch(self.get_starttag_text()):
+            raise UnsupportedMarkup()
+        if tag not in self.kept_tags:
+            self.skip_tag()
+            return
+        raw_attrs = {}
+        for name, value in attrs:
+            # the first of repeated attributes counts
+            if name not in raw_attrs:
+                raw_attrs[name] = (
+                    "" if value is None else value.replace(amp_marker, "&")
+                )
+        attrs = list(raw_attrs.items())
+        attrs = self.get_attrs(tag, attrs)
+        if tag in p_closing_tags:
+            self.close_p()
+            self.insert(tag, attrs)
+        elif tag in heading_tags:
+            self.close_p()
+            if self.open_elements and self.open_elements[-1].tag in heading_tags:
+                self.pop()
+            self.insert(tag, attrs)
+        elif tag == "li":
+            self.close_li()
+            self.close_p()
+            self.insert(tag, attrs)
+        elif tag in formatting_tags:
+            if tag == "a" and any(e.tag == "a" for e in self.formatting):
+                raise UnsupportedMarkup()
+            self.reconstruct_formatting()
+            self.push_formatting(self.insert(tag, attrs, raw_attrs))
+        elif tag in self_closing:
+            self.reconstruct_formatting()
+            self.insert(tag, attrs)
+        else:
+            raise UnsupportedMarkup()
+
+    def handle_startendtag(self, tag, attrs):
+        # a self-closing slash changes nothing in html
+        self.handle_starttag(tag, attrs)
+
+    def push_formatting(self, element):
+        # at most three identical formatting elements are reopened
+        matching = [
+            e
+            for e in self.formatting
+            if e.tag == element.tag and e.raw_attrs == element.raw_attrs
+        ]
+        if len(matching) == 3:
+            self.formatting.remove(matching[0])
+        self.formatting.append(element)
+
+    def close_li(self):
+        for element in reversed(self.open_elements):
+            if element.tag == "li":
+                self.generate_implied_end_tags(exclude="li")
+                self.pop_until(element)
+                return
+            if element.tag in special_tags and element.tag not in ["div", "p"]:
+                return
+
+    def handle_endtag(self, tag):
+        if tag not in self.kept_tags:
+            self.skip_tag()
+        elif tag in p_closing_tags and tag != "p":
+            element = self.find_open([tag])
+            if element is not None:
+                self.generate_implied_end_tags()
+                self.pop_until(element)
+        elif tag == "p":
+            if self.find_open(["p"]) is None:
+                self.insert("p", [])
+            self.close_p()
+        elif tag == "li":
+            element = self.find_open(["li"], boundary=["ol", "ul"])
+            if element is not None:
+                self.generate_implied_end_tags(exclude="li")
+                self.pop_until(element)
+        elif tag in heading_tags:
+            element = self.find_open(heading_tags)
+            if element is not None:
+                self.generate_implied_end_tags()
+                self.pop_until(element)
+        elif tag in formatting_tags:
+            self.adopt(tag)
+        elif tag == "br":
+            # html reads </br> as <br>
+            self.reconstruct_formatting()
+            self.insert("br", [])
+        elif tag in self_closing:
+            self.close_other(tag)
+        else:
+            raise UnsupportedMarkup()
+
+    def adopt(self, tag):
+        # the adoption agency algorithm, short of moving elements around
+        for element in reversed(self.formatting):
+            if element.tag == tag:
+                break
+        else:
+            self.close_other(tag)
+            return
+        if element not in self.open_elements:
+            self.formatting.remove(element)
+            return
+        i = self.open_elements.index(element)
+        if any(e.tag in special_tags for e in self.open_elements[i + 1 :]):
+            raise UnsupportedMarkup()
+        self.pop_until(element)
+        self.formatting.remove(element)
+
+    def close_other(self, tag):
+        for element in reversed(self.open_elements):
+            if element.tag == tag:
+                self.generate_implied_end_tags(exclude=tag)
+                self.pop_until(element)
+                return
+            if element.tag in special_tags:
+                return
+
+
+class HTMLSanitizer(PageSequencer):
+    # writes out the markup bleach_clean would for the same tags, instead of
+    # a sequence
+    def __init__(self, tags):
+        super().__init__(tags=tags)
+        self.html = []
+
+    def getvalue(self):
+        return "".join(self.html)
+
+    def emit_text(self, text):
+        self.html.append(text)
+
+    def output_attrs(self, attrs):
+        return [(name, write_attr(value, escape_lt=True)) for name, value in attrs]
+
+    def start_tag(self, tag, attrs):
+        self.html.append(
+            "<{}{}>".format(tag, "".join(" {}={}".format(*attr) for attr in attrs))
+        )
+
+    def end_tag(self, tag):
+        self.html.append(close_tag(tag))
 
 
 def list_difference(xs, ys):
@@ -241,11 +1035,12 @@ def generate_html(sequence):
     html = []
     context = []
     for token in sequence:
-        shared, to_close, to_open = list_difference(context, token.context)
-        for tag, attrs in reversed(to_close):
-            html.append(close_tag(tag))
-        for tag, attrs in to_open:
-            html.append(open_tag(tag, attrs))
+        if token.context is not context:
+            shared, to_close, to_open = list_difference(context, token.context)
+            for tag, attrs in reversed(to_close):
+                html.append(close_tag(tag))
+            for tag, attrs in to_open:
+                html.append(open_tag(tag, attrs))
         if isinstance(token, DataToken):
             html.append(token.data)
         elif isinstance(token, TagToken):
@@ -263,26 +1058,42 @@ def startswith(l, prefix):
 
 
 def insert_tags(sequence, tag, predicate):
+    tagged = []
     prefix = None
     for add_tag, token in zip(predicate, sequence):
         if add_tag:
             if prefix is None or not startswith(token.context, prefix):
+                token = token.with_context(token.context + (tag,))
                 prefix = token.context
-            token.context.insert(len(prefix), tag)
+            else:
+                depth = len(prefix)
+                token = token.with_context(
+                    token.context[:depth] + (tag,) + token.context[depth:]
+                )
         else:
             prefix = None
+        tagged.append(token)
+    return tagged
+
+
+sequence_cache = LRUCache(max_cost=app.config["SEQUENCE_CACHE_TOKENS"])
 
 
 def get_sequence(data):
-    parser = HTMLSequencer()
-    parser.feed(data)
-    return parser.sequence
+    key = content_hash(data)
+    sequence = sequence_cache.get(key)
+    if sequence is None:
+        parser = HTMLSequencer()
+        parser.feed(data)
+        sequence = tuple(parser.sequence)
+        sequence_cache.put(key, sequence)
+    return sequence
 
 
 def add_diff_to_context(matcher, sequence_a, sequence_b):
     merged_sequence = []
     diff = []
-    for tag, i1, i2, j1, j2 in stretched_opcodes(matcher, sequence_a, sequence_b):
+    for tag, i1, i2, j1, j2 in stretched_opcodes(matcher):
         if tag == "equal":
             merged_sequence += sequence_b[j1:j2]
             diff += ["equal"] * (j2 - j1)
@@ -292,21 +1103,27 @@ def add_diff_to_context(matcher, sequence_a, sequence_b):
         if tag == "replace" or tag == "insert":
             merged_sequence += sequence_b[j1:j2]
             diff += ["ins"] * (j2 - j1)
-    insert_tags(merged_sequence, ("del", []), (x == "del" for x in diff))
-    insert_tags(merged_sequence, ("ins", []), (x == "ins" for x in diff))
+    merged_sequence = insert_tags(
+        merged_sequence, ("del", ()), (x == "del" for x in diff)
+    )
+    merged_sequence = insert_tags(
+        merged_sequence, ("ins", ()), (x == "ins" for x in diff)
+    )
     return merged_sequence
 
 
 def wrap_brackets(tokens):
-    for token in tokens:
+    tokens = list(tokens)
+    for i, token in enumerate(tokens):
         if isinstance(token, DataToken) and is_word(token.data):
             l, s, r = splitstrip(token.data)
-            token.data = l + "[" + s + r
+            tokens[i] = token.with_data(l + "[" + s + r)
             break
-    for token in reversed(tokens):
+    for i in reversed(range(len(tokens))):
+        token = tokens[i]
         if isinstance(token, DataToken) and is_word(token.data):
             l, s, r = splitstrip(token.data)
-            token.data = l + s + "]" + r
+            tokens[i] = token.with_data(l + s + "]" + r)
             break
     return tokens
 
@@ -322,35 +1139,37 @@ def contains_word(tokens):
     return False
 
 
-def stretched_opcodes(matcher, sequence_a, sequence_b, n=5, depth=0, maxdepth=3):
-    marked_dirty = False
+def change_tag(i1, i2, j1, j2):
+    if i1 < i2 and j1 < j2:
+        return "replace"
+    elif i1 < i2:
+        return "delete"
+    return "insert"
+
+
+def stretched_opcodes(matcher, n=5):
+    # fold equal runs shorter than n tokens into the neighbouring changes, so
+    # that an edit reads as one replaced phrase rather than a patchwork of
+    # single matching words
     opcodes = matcher.get_opcodes()
-    for tag, i1, i2, j1, j2 in opcodes:
-        if tag == "equal" and (j2 - j1) < n:
-            for token in sequence_b[j1:j2]:
-                marked_dirty = True
-                token.mark_dirty()
-    if not marked_dirty:
+    if len(opcodes) < 2:
         return opcodes
-    stretched_matcher = SequenceMatcher(
-        isjunk=None, a=sequence_a, b=sequence_b, autojunk=False
-    )
-    if depth >= maxdepth:
-        return stretched_matcher.get_opcodes()
-    return stretched_opcodes(
-        stretched_matcher,
-        sequence_a,
-        sequence_b,
-        n=n,
-        depth=depth + 1,
-        maxdepth=maxdepth,
-    )
+    stretched = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and j2 - j1 >= n:
+            stretched.append((tag, i1, i2, j1, j2))
+        elif stretched and stretched[-1][0] != "equal":
+            _, i1, _, j1, _ = stretched[-1]
+            stretched[-1] = (change_tag(i1, i2, j1, j2), i1, i2, j1, j2)
+        else:
+            stretched.append((change_tag(i1, i2, j1, j2), i1, i2, j1, j2))
+    return stretched
 
 
 def add_concise_diff_to_context(matcher, sequence_a, sequence_b):
     merged_sequence = []
     diff = []
-    for tag, i1, i2, j1, j2 in stretched_opcodes(matcher, sequence_a, sequence_b):
+    for tag, i1, i2, j1, j2 in stretched_opcodes(matcher):
         if tag == "equal":
             merged_sequence += sequence_b[j1:j2]
             diff += ["equal"] * (j2 - j1)
@@ -361,22 +1180,72 @@ def add_concise_diff_to_context(matcher, sequence_a, sequence_b):
         if tag == "replace" or tag == "insert":
             merged_sequence += wrap_brackets(sequence_b[j1:j2])
             diff += ["ins"] * (j2 - j1)
-    insert_tags(merged_sequence, ("del", []), (x == "del" for x in diff))
-    insert_tags(merged_sequence, ("ins", []), (x == "ins" for x in diff))
+    merged_sequence = insert_tags(
+        merged_sequence, ("del", ()), (x == "del" for x in diff)
+    )
+    merged_sequence = insert_tags(
+        merged_sequence, ("ins", ()), (x == "ins" for x in diff)
+    )
     return merged_sequence
 
 
-def markup_changes(data_a, data_b, concise=False):
+def block_context(context):
+    for depth in reversed(range(len(context))):
+        if context[depth][0] in block_tags:
+            return context[: depth + 1]
+    return ()
+
+
+def block_bounds(sequence):
+    # a block is a run of tokens inside the same innermost block element,
+    # also ended by a <br>. sibling elements with the same tag are kept
+    # apart by the empty token the sequencer puts between them
+    bounds = [0]
+    block_contexts = {}
+    token_context = block = None
+    for i, token in enumerate(sequence):
+        if token.context is not token_context:
+            token_context = token.context
+            context = block_contexts.get(token_context)
+            if context is None:
+                context = block_contexts[token_context] = block_context(token_context)
+            if context != block and i > bounds[-1]:
+                bounds.append(i)
+            block = context
+        if type(token) is TagToken and token.tag == "br":
+            bounds.append(i + 1)
+    if bounds[-1] != len(sequence):
+        bounds.append(len(sequence))
+    return bounds
+
+
+def get_diff_matcher(sequence_a, sequence_b, budget=None):
+    if max(len(sequence_a), len(sequence_b)) < app.config["DIFF_BLOCK_MIN_TOKENS"]:
+        return get_matcher(sequence_a, sequence_b, budget=budget)
+    return BlockMatcher(
+        sequence_a,
+        sequence_b,
+        block_bounds(sequence_a),
+        block_bounds(sequence_b),
+        budget=budget,
+    )
+
+
+# bump whenever the rendered diff format changes, so stored diffs go stale
+markup_version = 1
+
+
+def markup_changes(data_a, data_b, concise=False, budget=None):
     sequence_a = get_sequence(data_a)
     sequence_b = get_sequence(data_b)
-    matcher = SequenceMatcher(isjunk=None, a=sequence_a, b=sequence_b, autojunk=False)
+    matcher = get_diff_matcher(sequence_a, sequence_b, budget)
     diff_fn = add_concise_diff_to_context if concise else add_diff_to_context
     merged_sequence = diff_fn(matcher, sequence_a, sequence_b)
     return generate_html(merged_sequence)
 
 
 def compute_diff(data_a, data_b):
-    matcher = SequenceMatcher(isjunk=None, a=data_a, b=data_b, autojunk=False)
+    matcher = get_matcher(data_a, data_b)
     for tag, i1, i2, j1, j2 in matcher.get_opcodes():
         if tag == "equal":
             yield ("equal", i1, i2, j1, j2)
@@ -424,26 +1293,91 @@ def align_diffs(diff_list):
         shared_i1 = i2_min
 
 
-def get_changes(aligned_chunks, data_original, data_new_list):
+def get_changes(aligned_chunks, data_original, inserts_list):
+    # equal chunks are the original tokens and deletes are empty, so the
+    # only tokens needed from each new version are the ones it inserts
     for i1, i2, chunk in aligned_chunks:
-        yield data_original[i1:i2], [
-            data_new_list[i][j1:j2] for i, (op, j1, j2) in enumerate(chunk)
-        ]
+        original = data_original[i1:i2]
+        change_list = []
+        changed = []
+        for inserts, (op, j1, j2) in zip(inserts_list, chunk):
+            if op == "equal":
+                change_list.append(original)
+                changed.append(False)
+            elif op == "delete":
+                change_list.append(())
+                changed.append(i1 < i2)
+            else:
+                change_list.append(inserts[j1])
+                changed.append(True)
+        yield original, change_list, changed
 
 
 def all_equal(data_list):
     return all(data == data_list[0] for data in data_list[1:])
 
 
-def diffn(data_original, data_new_list):
-    diff_list = []
-    for data_new in data_new_list:
-        diff_list.append(compute_diff(data_original, data_new))
+def merge_script(data_original, data_new):
+    # everything merging needs to know about data_new: its diff against
+    # data_original and the tokens it inserts, keyed by where they start
+    sequence_original = get_sequence(data_original)
+    if data_new == data_original:
+        return [("equal", 0, len(sequence_original), 0, len(sequence_original))], {}
+    sequence_new = get_sequence(data_new)
+    opcodes = list(compute_diff(sequence_original, sequence_new))
+    inserts = {
+        j1: sequence_new[j1:j2] for op, i1, i2, j1, j2 in opcodes if op == "insert"
+    }
+    return opcodes, inserts
+
+
+def dump_tokens(tokens):
+    dumped = []
+    for token in tokens:
+        context = [
+            [tag, [list(attr) for attr in attrs]] for tag, attrs in token.context
+        ]
+        if isinstance(token, DataToken):
+            dumped.append(["data", token.data, context])
+        else:
+            dumped.append(["tag", token.tag, context, [list(a) for a in token.attrs]])
+    return dumped
+
+
+def load_tokens(dumped, contexts):
+    tokens = []
+    for kind, value, context, *attrs in dumped:
+        context = tuple(
+            (tag, tuple(tuple(attr) for attr in attrs)) for tag, attrs in context
+        )
+        context = contexts.setdefault(context, context)
+        if kind == "data":
+            tokens.append(DataToken(value, context))
+        else:
+            tokens.append(TagToken(value, context, (tuple(a) for a in attrs[0])))
+    return tuple(tokens)
+
+
+def dump_script(script):
+    opcodes, inserts = script
+    return (
+        [list(opcode) for opcode in opcodes],
+        [[j1, dump_tokens(tokens)] for j1, tokens in inserts.items()],
+    )
+
+
+def load_script(dumped, contexts):
+    opcodes, inserts = dumped
+    return opcodes, {j1: load_tokens(tokens, contexts) for j1, tokens in inserts}
+
+
+def diffn(data_original, script_list):
+    diff_list = [iter(opcodes) for opcodes, inserts in script_list]
     aligned_chunks = align_diffs(diff_list)
-    for original, change_list in get_changes(
-        aligned_chunks, data_original, data_new_list
+    for original, change_list, changed in get_changes(
+        aligned_chunks, data_original, [inserts for opcodes, inserts in script_list]
     ):
-        changes = [i for i, change in enumerate(change_list) if change != original]
+        changes = [i for i, is_changed in enumerate(changed) if is_changed]
         if len(changes) == 0:
             yield ("equal", original)
         elif len(changes) == 1:
@@ -454,14 +1388,31 @@ def diffn(data_original, data_new_list):
             yield ("conflict", list(set(tuple(change) for change in change_list)))
 
 
-def merge_html(data_original, data_new_list):
+def merge_scripts(data_original, script_list):
     merged_tokens = []
-    for op, chunk in diffn(
-        get_sequence(data_original), [get_sequence(data) for data in data_new_list]
-    ):
+    for op, chunk in diffn(get_sequence(data_original), script_list):
         if op == "equal" or op == "edit":
             merged_tokens += chunk
         elif op == "conflict":
             for change in chunk:
                 merged_tokens += wrap_brackets(change)
     return generate_html(merged_tokens)
+
+
+def merge_html(data_original, data_new_list):
+    return merge_scripts(
+        data_original, [merge_script(data_original, data) for data in data_new_list]
+    )
+
+
+def merge_dumped(data_original, data_new_list, dumped_list):
+    # stored scripts stand in for the new versions they were made from, the
+    # rest are diffed here
+    contexts = {}
+    script_list = []
+    for data, dumped in zip(data_new_list, dumped_list):
+        if dumped is None:
+            script_list.append(merge_script(data_original, data))
+        else:
+            script_list.append(load_script(dumped, contexts))
+    return merge_scripts(data_original, script_list)
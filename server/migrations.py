@@ -0,0 +1,78 @@
+import click
+from pymongo import ASCENDING, UpdateOne
+
+from .app import app
+from .page import Page, PageVersion, VersionDiff, prefetch
+from .activity import Activity
+
+
+@app.cli.command("migrate-history")
+def migrate_history():
+    """Move pages' versions and diffs lists into seqs on the versions and diffs.
+
+    Run it with the server stopped. A page is only rewritten once its history
+    has been numbered, so it can be run again after being interrupted.
+    """
+    pages = Page._mongometa.collection
+    versions = PageVersion._mongometa.collection
+    diffs = VersionDiff._mongometa.collection
+    migrated = 0
+    for document in pages.find(
+        {"versions": {"$exists": True}},
+        {"versions": 1, "diffs": 1, "primary_diffs": 1},
+    ):
+        for collection, ids in [
+            (versions, document["versions"]),
+            (diffs, document.get("diffs", [])),
+        ]:
+            if ids:
+                collection.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": _id},
+                            {"$set": {"page": document["_id"], "seq": seq}},
+                        )
+                        for seq, _id in enumerate(ids)
+                    ]
+                )
+        update = {
+            "$set": {"num_versions": len(document["versions"])},
+            "$unset": {"versions": "", "diffs": "", "primary_diffs": ""},
+        }
+        if document.get("primary_diffs"):
+            update["$set"]["primary_diff"] = document["primary_diffs"][-1]
+        pages.update_one({"_id": document["_id"]}, update)
+        migrated += 1
+    click.echo("Moved the history of {} pages".format(migrated))
+
+
+@app.cli.command("create-activity")
+def create_activity():
+    """Create the capped collection /recent/ lists edits from.
+
+    start.sh runs it before the server, as edits recorded first would go to an
+    uncapped collection. That one is capped if it's found, and a new one starts
+    off with every page's latest edit.
+    """
+    collection = Activity._mongometa.collection
+    if collection.name in collection.database.list_collection_names():
+        if not collection.options().get("capped"):
+            collection.database.command(
+                "convertToCapped",
+                collection.name,
+                size=app.config["ACTIVITY_FEED_BYTES"],
+            )
+            click.echo("Capped the activity collection")
+        return
+    collection.database.create_collection(
+        collection.name, capped=True, size=app.config["ACTIVITY_FEED_BYTES"]
+    )
+    pages = list(
+        Page.objects.raw({"num_versions": {"$gt": 1}})
+        .project({"head": 0})
+        .order_by([("last_edited", ASCENDING)])
+    )
+    for i in range(0, len(pages), 100):
+        for page in prefetch(pages[i : i + 100], "latest", "latest_diff"):
+            Activity.record(page, page.latest_diff)
+    click.echo("Listed the latest edits of {} pages".format(len(pages)))
@@ -0,0 +1,153 @@
+import multiprocessing
+import threading
+import time
+
+from .app import app
+from .diff import DiffBudget
+from .html_utils import markup_changes, merge_dumped
+from .errors import *
+
+# workers are started from request threads, and one forked from them could
+# inherit a lock another thread held (like a cache's) and never get it. the
+# fork server is a separate process with nothing else running
+multiprocessing.set_start_method("forkserver", force=True)
+
+# workers waiting for a task, and a slot for each worker that can be running
+idle_workers = []
+worker_slots = None
+slots_lock = threading.Lock()
+
+
+class OffloadFailed(Exception):
+    # the task ran out of time or its worker died, so there's no result
+    pass
+
+
+class Worker:
+    # a process that runs the tasks sent to it one at a time, so one that's
+    # stuck can be stopped without the others
+    def __init__(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve, args=(child_connection,), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+
+    def run(self, fn, args, timeout):
+        try:
+            self.connection.send((fn, args))
+            if not self.connection.poll(max(timeout, 0)):
+                raise OffloadFailed()
+            raised, value = self.connection.recv()
+        except (EOFError, OSError):
+            raise OffloadFailed()
+        if raised:
+            raise value
+        return value
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def serve(connection):
+    while True:
+        try:
+            fn, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            connection.send((False, fn(*args)))
+        except Exception as e:
+            connection.send((True, e))
+
+
+def get_slots():
+    global worker_slots
+    with slots_lock:
+        if worker_slots is None:
+            worker_slots = threading.Semaphore(app.config["DIFF_OFFLOAD_WORKERS"])
+        return worker_slots
+
+
+def take_worker():
+    try:
+        return idle_workers.pop()
+    except IndexError:
+        return Worker()
+
+
+def should_offload(length):
+    return (
+        app.config["DIFF_OFFLOAD_WORKERS"] > 0
+        and length >= app.config["DIFF_OFFLOAD_MIN_LENGTH"]
+    )
+
+
+def run_offloaded(fn, *args):
+    # the timeout counts the wait for a free worker too
+    timeout = app.config["DIFF_OFFLOAD_TIMEOUT"]
+    deadline = time.monotonic() + timeout
+    slots = get_slots()
+    if not slots.acquire(timeout=timeout):
+        raise OffloadFailed()
+    try:
+        worker = take_worker()
+        try:
+            result = worker.run(fn, args, deadline - time.monotonic())
+        except OffloadFailed:
+            # it could still be running fn, so stop it and let the next task
+            # start a fresh one
+            worker.stop()
+            raise
+        except Exception:
+            idle_workers.append(worker)
+            raise
+        idle_workers.append(worker)
+        return result
+    finally:
+        slots.release()
+
+
+def markup_changes_task(data_a, data_b, concise, max_tokens, seconds):
+    # budgets can't be shared between processes, so the worker gets a fresh
+    # one with whatever the caller had left and reports back its fallbacks
+    budget = DiffBudget(max_tokens, seconds)
+    body_diff = markup_changes(data_a, data_b, concise=concise, budget=budget)
+    return body_diff, budget.fallbacks
+
+
+def offload_markup_changes(data_a, data_b, concise=False, budget=None):
+    if not should_offload(len(data_a) + len(data_b)):
+        return markup_changes(data_a, data_b, concise=concise, budget=budget)
+    if budget is None:
+        budget = DiffBudget(float("inf"), float("inf"))
+    try:
+        body_diff, fallbacks = run_offloaded(
+            markup_changes_task,
+            data_a,
+            data_b,
+            concise,
+            budget.max_tokens,
+            budget.remaining(),
+        )
+    except OffloadFailed:
+        # show the whole body as replaced, rather than wait any longer or diff
+        # it here in the request
+        budget.fallbacks += 1
+        coarse = DiffBudget(max_tokens=0, seconds=0)
+        return markup_changes(data_a, data_b, concise=concise, budget=coarse)
+    budget.fallbacks += fallbacks
+    return body_diff
+
+
+def offload_merge_dumped(data_original, data_new_list, dumped_list):
+    length = len(data_original) + sum(len(data) for data in data_new_list)
+    if not should_offload(length):
+        return merge_dumped(data_original, data_new_list, dumped_list)
+    try:
+        return run_offloaded(merge_dumped, data_original, data_new_list, dumped_list)
+    except OffloadFailed:
+        raise MergeTimeout()
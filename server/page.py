@@ -1,21 +1,79 @@
 from pymodm import fields, MongoModel, EmbeddedMongoModel
+from pymodm.context_managers import no_auto_dereference
 from pymodm.errors import DoesNotExist
-from pymongo import ASCENDING, TEXT
+from pymodm.manager import Manager
+from pymodm.queryset import QuerySet
+from pymongo import ASCENDING, DESCENDING, TEXT
 from pymongo.errors import DuplicateKeyError
 from pymongo.operations import IndexModel
 from flask import g
+from datetime import timedelta
 
 from .sections import Section, SectionDiff, separate_sections, diff_sections
 from .html_utils import markup_changes
-from .app import timestamp
+from .app import app, timestamp
+from .cache import LRUCache
 from .errors import *
 
+# titles to page names, for linkify, with no_page for titles nobody has
+# taken. renames and new pages in this process drop entries right away,
+# ones in other processes show up once the entries expire
+no_page = object()
+name_cache = LRUCache(
+    max_cost=app.config["NAME_CACHE_SIZE"],
+    cost=lambda name: 1,
+    ttl=app.config["NAME_CACHE_TTL"],
+)
+
+# a page's history is the versions and diffs with a seq, numbered from 0. only
+# one edit can take the next seq, and it only counts once the page's
+# num_versions has been bumped past it. proposals, merges and the like have no
+# seq and aren't in the history
+history_index = IndexModel(
+    [("page", ASCENDING), ("seq", ASCENDING)],
+    unique=True,
+    partialFilterExpression={"seq": {"$exists": True}},
+)
+# an edit that took a seq but never bumped num_versions is given this long to
+# finish before its seq is taken back
+abandoned_after = timedelta(minutes=1)
+
+
+def ref_id(document, name):
+    # the id in a reference field, without fetching what it refers to. fields
+    # are shared with subclasses but only follow the model they were last bound
+    # to, so that's the one to turn dereferencing off for
+    with no_auto_dereference(document._mongometa.get_field(name).model):
+        value = getattr(document, name)
+    return getattr(value, "_id", value)
+
+
+def prefetch(pages, *names):
+    # fetches what each name refers to for all the pages at once, instead of a
+    # page at a time as the templates get to them: latest, latest_diff, and
+    # user_version for user pages. pages missing what a name refers to are left
+    # out, rather than failing the whole list
+    for name in names:
+        prefetchers = {getattr(type(page), "prefetch_" + name, None) for page in pages}
+        for prefetcher in prefetchers - {None}:
+            missing = prefetcher(pages) or set()
+            pages = [page for page in pages if page._id not in missing]
+    return pages
+
+
+class PageQuerySet(QuerySet):
+    def prefetch(self, *names):
+        return prefetch(list(self), *names)
+
 
 class Page(MongoModel):
     titles = fields.ListField(fields.CharField())
     freshness = fields.IntegerField(default=0)
     search_terms = fields.ListField(fields.CharField(), blank=True)
     last_edited = fields.DateTimeField(default=0)
+    num_versions = fields.IntegerField(default=0)
+
+    objects = Manager.from_queryset(PageQuerySet)()
 
     class Meta:
         indexes = [
@@ -23,26 +81,186 @@ class Page(MongoModel):
             IndexModel([("search_terms", TEXT)]),
         ]
 
-    def save_if_fresh(self):
-        old_freshness = self.freshness
-        self.freshness += 1
+    def update_if_fresh(self, *fields, inc=None):
+        # sends the given fields, the changes staged by push, and counters that
+        # went up by inc, all already made on self, if nobody else has updated
+        # the page since it was loaded
+        fields = set(fields)
+        fields.update(name for name, items in self.staged.items() if items is None)
+        update = {"$inc": dict(inc or {}, freshness=1)}
+        for name in fields:
+            value = getattr(self, name)
+            if value is not None:
+                value = self._mongometa.get_field(name).to_mongo(value)
+            update.setdefault("$set", {})[name] = value
+        for name, items in self.staged.items():
+            if name not in fields:
+                update.setdefault("$push", {})[name] = {"$each": items}
         try:
-            update = self._mongometa.collection.replace_one(
-                {"_id": self._id, "freshness": old_freshness}, self.to_son()
+            result = self._mongometa.collection.update_one(
+                {"_id": self._id, "freshness": self.freshness}, update
             )
         except DuplicateKeyError:
             raise DuplicatePage()
-        if update.modified_count == 0:
+        if result.modified_count == 0:
+            raise RaceCondition()
+        self.freshness += 1
+        self._staged = {}
+        self.forget_names()
+
+    @property
+    def staged(self):
+        # list fields to items appended to them since the page was loaded, or
+        # to None when they changed otherwise and have to be sent whole
+        if not hasattr(self, "_staged"):
+            self._staged = {}
+        return self._staged
+
+    def push(self, name, item):
+        getattr(self, name).append(item)
+        if self.staged.get(name, []) is not None:
+            self.staged.setdefault(name, []).append(item)
+
+    def add_history(self, version, diff):
+        # saves version and diff as the next in the history, for
+        # update_if_fresh to make visible, or drop_history to take back
+        version.page = diff.page = self
+        version.seq = diff.seq = self.num_versions
+        try:
+            version.save()
+        except DuplicateKeyError:
+            self.drop_abandoned(version.seq)
             raise RaceCondition()
+        diff.save()
+        self.num_versions += 1
+        self._latest = version
+        self._latest_diff = diff
+
+    def drop_history(self, version, diff):
+        version.delete()
+        diff.delete()
+
+    def drop_abandoned(self, seq):
+        # the edit that took seq could still commit, so the page's freshness is
+        # bumped first, only while seq is uncommitted. then either the edit's
+        # update_if_fresh fails, or it got there first and nothing is deleted
+        try:
+            version = PageVersion.objects.get(
+                {
+                    "page": self._id,
+                    "seq": seq,
+                    "timestamp": {"$lt": timestamp() - abandoned_after},
+                }
+            )
+        except DoesNotExist:
+            return
+        result = self._mongometa.collection.update_one(
+            {"_id": self._id, "num_versions": {"$lte": seq}},
+            {"$inc": {"freshness": 1}},
+        )
+        if result.modified_count == 0:
+            return
+        VersionDiff.objects.raw(
+            {"page": self._id, "seq": seq, "version_b": version._id}
+        ).delete()
+        version.delete()
+
+    def get_head(self):
+        # pages saved before heads were stored get one on first view, unless
+        # an edit gets in first with its own
+        if self.head is None:
+            self.head = self.make_head()
+            field = self._mongometa.get_field("head")
+            self._mongometa.collection.update_one(
+                {"_id": self._id, "freshness": self.freshness},
+                {"$set": {"head": field.to_mongo(self.head)}},
+            )
+        return self.head
+
+    def get_version(self, num):
+        return PageVersion.objects.get({"page": self._id, "seq": num})
+
+    @property
+    def latest(self):
+        if not hasattr(self, "_latest"):
+            self._latest = self.get_version(self.num_versions - 1)
+        return self._latest
+
+    @property
+    def latest_diff(self):
+        if not hasattr(self, "_latest_diff"):
+            self._latest_diff = VersionDiff.objects.get(
+                {"page": self._id, "seq": self.num_versions - 1}
+            )
+        return self._latest_diff
+
+    @staticmethod
+    def prefetch_latest(pages):
+        return Page.fetch_latest(PageVersion, pages, "_latest")
+
+    @staticmethod
+    def prefetch_latest_diff(pages):
+        return Page.fetch_latest(VersionDiff, pages, "_latest_diff")
+
+    @staticmethod
+    def fetch_latest(model, pages, attribute):
+        # sets the latest of each page's versions or diffs as attribute, by the
+        # page and seq of each in one query, and returns the ids of the pages
+        # it's missing for
+        pages = [page for page in pages if not hasattr(page, attribute)]
+        if not pages:
+            return set()
+        latest = {
+            ref_id(document, "page"): document
+            for document in model.objects.raw(
+                {
+                    "$or": [
+                        {"page": page._id, "seq": page.num_versions - 1}
+                        for page in pages
+                    ]
+                }
+            )
+        }
+        for page in pages:
+            if page._id in latest:
+                setattr(page, attribute, latest[page._id])
+        return {page._id for page in pages if page._id not in latest}
+
+    def history(self, before=None, limit=0):
+        # (version, diff) pairs, newest first, going back from before by seq
+        if before is None:
+            before = self.num_versions
+        versions = list(
+            PageVersion.objects.raw({"page": self._id, "seq": {"$lt": before}})
+            .order_by([("seq", DESCENDING)])
+            .limit(limit)
+        )
+        if not versions:
+            return []
+        query = {"page": self._id, "seq": {"$gte": versions[-1].seq, "$lt": before}}
+        diffs = {diff.seq: diff for diff in VersionDiff.objects.raw(query)}
+        return [
+            (version, diffs[version.seq])
+            for version in versions
+            if version.seq in diffs
+        ]
+
+    def forget_names(self):
+        for title in self.titles:
+            name_cache.discard(title)
 
     def add_title(self, title):
+        self.forget_names()
         if title in self.titles:
+            if title == self.titles[-1]:
+                return
             self.titles.remove(title)
-        self.titles.append(title)
+            self.staged["titles"] = None
+        self.push("titles", title)
 
     def add_search_term(self, term):
         if term not in self.search_terms:
-            self.search_terms.append(term)
+            self.push("search_terms", term)
 
     @property
     def is_bookmarked(self):
@@ -52,36 +270,94 @@ class Page(MongoModel):
         return BookmarksPage.find().is_bookmarked(self.titles)
 
     def trigger_backlinks(self, new_links):
-        for link in new_links:
-            try:
-                page = Page.find(link)
-            except PageNotFound:
-                pass
-            if page.can_edit:
-                try:
-                    page.add_backlink(self.titles)
-                except RaceCondition:
-                    # would be nice to still make the link eventually hmm...
-                    pass
+        # made by the backlinks worker, so the edit doesn't wait on them
+        from .backlinks import queue_backlinks
+
+        queue_backlinks(self, new_links)
 
     @property
     def title(self):
         return self.titles[-1]
 
     @staticmethod
-    def find(title):
+    def find(title, head=False):
+        # the head is what viewing the page shows, and edits write a new one,
+        # so only views load it
+        pages = Page.objects if head else Page.objects.project({"head": 0})
         try:
-            return Page.objects.get({"titles": title})
+            return pages.get({"titles": title})
         except DoesNotExist:
             raise PageNotFound()
 
+    @staticmethod
+    def find_names(titles):
+        names = {}
+        missing = []
+        for title in titles:
+            name = name_cache.get(title)
+            if name is None:
+                missing.append(title)
+            elif name is not no_page:
+                names[title] = name
+        if missing:
+            fetched = Page.fetch_names(missing)
+            for title in missing:
+                name_cache.put(title, fetched.get(title, no_page))
+            for title, name in fetched.items():
+                name_cache.put(title, name)
+                names[title] = name
+        return names
+
+    @staticmethod
+    def fetch_names(titles):
+        # names live on the latest versions, so fetch just those in one more
+        # query, by the page and seq of each
+        pages = [
+            document
+            for document in Page.objects.raw({"titles": {"$in": list(titles)}})
+            .project({"_cls": 1, "titles": 1, "num_versions": 1})
+            .values()
+            if document.get("num_versions")
+        ]
+        if not pages:
+            return {}
+        latest = {
+            document["page"]: PageVersion.from_document(document)
+            for document in PageVersion.objects.raw(
+                {
+                    "$or": [
+                        {"page": page["_id"], "seq": page["num_versions"] - 1}
+                        for page in pages
+                    ]
+                }
+            )
+            .project({"_cls": 1, "page": 1, "name": 1, "aka": 1})
+            .values()
+        }
+        names = {}
+        for document in pages:
+            # a page without its latest version is left for linkify to treat
+            # as missing
+            if document["_id"] not in latest:
+                continue
+            page = Page.from_document(document)
+            page._latest = latest[document["_id"]]
+            for title in page.titles:
+                names[title] = page.name
+        return names
+
     @staticmethod
     def search(query, limit=20):
-        return list(Page.objects.raw({"$text": {"$search": query}}).limit(limit))
+        return list(
+            Page.objects.raw({"$text": {"$search": query}})
+            .project({"head": 0})
+            .limit(limit)
+        )
 
 
 class PageVersion(MongoModel):
     page = fields.ReferenceField(Page)
+    seq = fields.IntegerField(blank=True)
     timestamp = fields.DateTimeField()
     editor = fields.ReferenceField("User", blank=True)
     flag = fields.EmbeddedDocumentField("Flag")
@@ -89,7 +365,10 @@ class PageVersion(MongoModel):
     links = fields.ListField(fields.CharField(), default=[], blank=True)
 
     class Meta:
-        indexes = [IndexModel([("editor", ASCENDING), ("is_flagged", ASCENDING)])]
+        indexes = [
+            IndexModel([("editor", ASCENDING), ("is_flagged", ASCENDING)]),
+            history_index,
+        ]
 
     def set_flag(self):
         assert g.user is not None
@@ -111,9 +390,14 @@ class PageVersion(MongoModel):
 
 
 class VersionDiff(MongoModel):
+    page = fields.ReferenceField(Page)
+    seq = fields.IntegerField(blank=True)
     version_a = fields.ReferenceField(PageVersion)
     version_b = fields.ReferenceField(PageVersion)
 
+    class Meta:
+        indexes = [history_index]
+
 
 class Flag(EmbeddedMongoModel):
     version = fields.ReferenceField(PageVersion)
@@ -1,21 +1,36 @@
 import itertools
+from collections import defaultdict
 from pymodm import fields, MongoModel, EmbeddedMongoModel
-from difflib import SequenceMatcher
 
 from .html_utils import (
     get_sequence,
-    markup_changes,
     generate_html,
     Token,
     header_tags,
     DataToken,
+    set_slot,
 )
+from .cache import content_hash
+from .diff import DiffBudget, get_matcher
+from .diff_memo import memo_markup_changes
+from .offload import offload_merge_dumped
 
 
 class Section(EmbeddedMongoModel):
     heading = fields.CharField()
     level = fields.IntegerField()
     body = fields.CharField(blank=True)
+    digest = fields.CharField(blank=True)
+
+    def clean(self):
+        self.digest = content_hash(self.body)
+
+    @property
+    def body_hash(self):
+        # versions saved before digests were stored get hashed on first use
+        if not self.digest:
+            self.digest = content_hash(self.body)
+        return self.digest
 
 
 class SectionDiff(EmbeddedMongoModel):
@@ -23,12 +38,23 @@ class SectionDiff(EmbeddedMongoModel):
     level = fields.IntegerField()
     body = fields.CharField(blank=True)
     body_diff = fields.CharField(blank=True)
+    digest = fields.CharField(blank=True)
 
     inserted = fields.BooleanField(default=False)
     deleted = fields.BooleanField(default=False)
     edited = fields.BooleanField(default=False)
+    degraded = fields.BooleanField(default=False)
     idx = fields.IntegerField(default=None)
 
+    def clean(self):
+        self.digest = content_hash(self.body)
+
+    @property
+    def body_hash(self):
+        if not self.digest:
+            self.digest = content_hash(self.body)
+        return self.digest
+
     @property
     def is_empty(self):
         return not (self.inserted or self.deleted or self.edited)
@@ -50,7 +76,10 @@ def extract_text(tokens):
 
 
 def separate_sections(data):
-    sequence = get_sequence(data)
+    return separate_sequence(get_sequence(data))
+
+
+def separate_sequence(sequence):
     keys = []
     groups = []
     for key, group in itertools.groupby(sequence, key=get_header_level):
@@ -78,61 +107,204 @@ def separate_sections(data):
 
 
 class SectionToken(Token):
+    __slots__ = ("heading", "body", "level", "digest")
+
     def __init__(self, section):
-        self.heading = section.heading
-        self.body = section.body
-        self.level = section.level
-        super().__init__((self.heading, self.level))
+        super().__init__((section.heading, section.level))
+        set_slot(self, "heading", section.heading)
+        set_slot(self, "body", section.body)
+        set_slot(self, "level", section.level)
+        set_slot(self, "digest", section.body_hash)
+
+
+def diff_bodies(body_a, body_b, concise, budget):
+    fallbacks = budget.fallbacks
+    body_diff = memo_markup_changes(body_a, body_b, concise=concise, budget=budget)
+    return body_diff, budget.fallbacks > fallbacks
+
 
+def diff_pair(section_a, section_b, idx, concise, budget):
+    edited = section_a.digest != section_b.digest
+    if edited:
+        body_diff, degraded = diff_bodies(
+            section_a.body, section_b.body, concise, budget
+        )
+    else:
+        # a diff with no changes renders as the body itself
+        body_diff, degraded = section_b.body, False
+    return SectionDiff(
+        heading=section_b.heading,
+        level=section_b.level,
+        body_diff=body_diff,
+        body=section_b.body,
+        digest=section_b.digest,
+        idx=idx,
+        edited=edited,
+        degraded=degraded,
+    )
+
+
+def diff_deleted(section, concise):
+    body_diff = memo_markup_changes(section.body, "", concise=concise)
+    return SectionDiff(
+        heading=section.heading,
+        level=section.level,
+        body_diff=body_diff,
+        body=section.body,
+        deleted=True,
+    )
+
+
+def diff_inserted(section, idx, concise):
+    body_diff = memo_markup_changes("", section.body, concise=concise)
+    return SectionDiff(
+        heading=section.heading,
+        level=section.level,
+        body_diff=body_diff,
+        body=section.body,
+        idx=idx,
+        inserted=True,
+    )
+
+
+def rediff_sections(sequence_a, sequence_b, previous, concise, budget):
+    # previous diffs sequence_a against sections laid out like sequence_b, so
+    # the sections line up the same way and only bodies that differ from the
+    # ones it has are diffed again
+    merged_sequence = []
+    i = 0
+    for section_diff in previous:
+        if section_diff.deleted:
+            merged_sequence.append(section_diff)
+            i += 1
+            continue
+        j = section_diff.idx
+        section_b = sequence_b[j]
+        if section_b.digest == section_diff.body_hash:
+            merged_sequence.append(section_diff)
+        elif section_diff.inserted:
+            merged_sequence.append(diff_inserted(section_b, j, concise))
+        else:
+            merged_sequence.append(
+                diff_pair(sequence_a[i], section_b, j, concise, budget)
+            )
+        if not section_diff.inserted:
+            i += 1
+    return merged_sequence
 
-def diff_sections(sections_a, sections_b, concise=False):
+
+def diff_sections(sections_a, sections_b, concise=False, budget=None, previous=None):
+    # previous can be the sections of an earlier diff from sections_a, to reuse
+    if budget is None:
+        budget = DiffBudget()
     sequence_a = [SectionToken(section) for section in sections_a]
     sequence_b = [SectionToken(section) for section in sections_b]
-    matcher = SequenceMatcher(isjunk=None, a=sequence_a, b=sequence_b, autojunk=False)
+    if previous is not None:
+        layout = [
+            (section.heading, section.level)
+            for section in previous
+            if not section.deleted
+        ]
+        if layout == [section.identity for section in sequence_b]:
+            return rediff_sections(sequence_a, sequence_b, previous, concise, budget)
+    if sequence_a == sequence_b:
+        # the same sections in the same places, as after an inline edit
+        opcodes = [("equal", 0, len(sequence_a), 0, len(sequence_b))]
+    else:
+        opcodes = get_matcher(sequence_a, sequence_b).get_opcodes()
     merged_sequence = []
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    for tag, i1, i2, j1, j2 in opcodes:
         if tag == "equal":
             for i, j in zip(range(i1, i2), range(j1, j2)):
-                section_a = sequence_a[i]
-                section_b = sequence_b[j]
-                edited = section_a.body != section_b.body
-                body_diff = markup_changes(
-                    section_a.body, section_b.body, concise=concise
-                )
                 merged_sequence.append(
-                    SectionDiff(
-                        heading=section_b.heading,
-                        level=section_b.level,
-                        body_diff=body_diff,
-                        body=section_b.body,
-                        idx=j,
-                        edited=edited,
-                    )
+                    diff_pair(sequence_a[i], sequence_b[j], j, concise, budget)
                 )
         if tag == "replace" or tag == "delete":
             for section in sequence_a[i1:i2]:
-                body_diff = markup_changes(section.body, "", concise=concise)
-                merged_sequence.append(
-                    SectionDiff(
-                        heading=section.heading,
-                        level=section.level,
-                        body_diff=body_diff,
-                        body=section.body,
-                        deleted=True,
-                    )
-                )
+                merged_sequence.append(diff_deleted(section, concise))
         if tag == "replace" or tag == "insert":
             for j in range(j1, j2):
-                section = sequence_b[j]
-                body_diff = markup_changes("", section.body, concise=concise)
-                merged_sequence.append(
-                    SectionDiff(
-                        heading=section.heading,
-                        level=section.level,
-                        body_diff=body_diff,
-                        body=section.body,
-                        idx=j,
-                        inserted=True,
+                merged_sequence.append(diff_inserted(sequence_b[j], j, concise))
+    return merged_sequence
+
+
+def align_sections(sequence_original, sections):
+    # which original sections are still there, by position in the original,
+    # and which new ones were inserted, by the position they were inserted at
+    sequence = [SectionToken(section) for section in sections]
+    matcher = get_matcher(sequence_original, sequence)
+    matches = {}
+    inserted = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            matches.update(zip(range(i1, i2), sequence[j1:j2]))
+        if tag == "replace" or tag == "insert":
+            inserted.append((i2, sequence[j1:j2]))
+    return matches, inserted
+
+
+def edited_sections(sections_original, sections):
+    sequence_original = [SectionToken(section) for section in sections_original]
+    matches, _ = align_sections(sequence_original, sections)
+    for i, section in sorted(matches.items()):
+        if section.digest != sequence_original[i].digest:
+            yield sequence_original[i], section
+
+
+def merge_sections(sections_original, sections_list, stored=None):
+    # stored maps (original digest, new digest) to a dumped merge script
+    stored = stored or {}
+    sequence_original = [SectionToken(section) for section in sections_original]
+    matches_list = []
+    inserted = defaultdict(list)
+    for sections in sections_list:
+        matches, inserts = align_sections(sequence_original, sections)
+        matches_list.append(matches)
+        for i, sequence in inserts:
+            inserted[i] += sequence
+    merged = []
+    for i in range(len(sequence_original) + 1):
+        seen = set()
+        for section in inserted[i]:
+            key = (section.heading, section.level, section.digest)
+            if key not in seen:
+                seen.add(key)
+                merged.append(
+                    Section(
+                        heading=section.heading, level=section.level, body=section.body
                     )
                 )
-    return merged_sequence
+        if i == len(sequence_original):
+            break
+        section = sequence_original[i]
+        # a section nobody edited is kept as is, or dropped if anyone deleted it
+        if all(
+            matches[i].digest == section.digest
+            for matches in matches_list
+            if i in matches
+        ):
+            if all(i in matches for matches in matches_list):
+                merged.append(sections_original[i])
+            continue
+        # otherwise a deletion only empties the body, like in a whole-page merge,
+        # and one copy of the original stands in for everyone who left it as is
+        bodies = []
+        dumped_list = []
+        for matches in matches_list:
+            if i not in matches:
+                bodies.append("")
+                dumped_list.append(None)
+            elif matches[i].digest != section.digest:
+                bodies.append(matches[i].body)
+                dumped_list.append(stored.get((section.digest, matches[i].digest)))
+        if len(bodies) < len(matches_list):
+            bodies.append(section.body)
+            dumped_list.append(None)
+        merged.append(
+            Section(
+                heading=section.heading,
+                level=section.level,
+                body=offload_merge_dumped(section.body, bodies, dumped_list),
+            )
+        )
+    return merged
@@ -1,4 +1,5 @@
 import re
+from bson import ObjectId
 from flask import render_template, abort, request, jsonify, g
 from flask import redirect as flask_redirect
 from functools import wraps
@@ -6,27 +7,31 @@ from pymongo import DESCENDING
 
 from .app import app, url_for
 from .html_utils import (
-    sanitize_html,
+    clean_page,
     sanitize_paragraph,
     sanitize_text,
     title_to_name,
     name_to_title,
+    sequence_cache,
 )
-from .sections import separate_sections, Section
+from .sections import Section
 from .templates import try_create_page, is_edu_email, is_email
-from .page import Page
+from .page import Page, name_cache, prefetch
 from .user import User
 from .user_page import UserPage, UserVersionDiff
 from .topic_page import TopicPage
 from .bookmarks import BookmarksPage
+from .activity import Activity
 from .mail import send_email
 from .errors import *
 from . import auth  # just to load handlers into the app
+from . import migrations  # just to load commands into the app
+from . import backlinks  # just to load commands into the app
 
 
 @app.context_processor
 def inject_models():
-    return dict(UserPage=UserPage, TopicPage=TopicPage)
+    return dict(UserPage=UserPage, TopicPage=TopicPage, UserVersionDiff=UserVersionDiff)
 
 
 def cast_param(val, cls):
@@ -82,6 +87,8 @@ def page_errors(fun):
             return error("Lel, looks like you're not allowed to do that.")
         except EmptyString:
             return error("Lel, that shouldn't be empty.")
+        except MergeTimeout:
+            return error("Lel, merging that edit took too long. Try a smaller change.")
 
     return wrapped_fun
 
@@ -176,29 +183,38 @@ def index():
 @app.route("/recent/")
 @error_handling
 def recent():
-    pages = list(
-        Page.objects.raw({"versions.1": {"$exists": True}})
-        .order_by([("last_edited", DESCENDING)])
-        .limit(20)
+    before = request.args.get("before")
+    if before is not None:
+        before = cast_param(before, ObjectId)
+    activities, older = Activity.recent(before, limit=20)
+    return render_template("recent.html", activities=activities, older=older)
+
+
+@app.route("/stats/")
+def stats():
+    # off unless turned on, as anyone could read it
+    if not app.config["STATS_ENABLED"]:
+        abort(404)
+    return jsonify(
+        {"sequence_cache": sequence_cache.stats(), "name_cache": name_cache.stats()}
     )
-    return render_template("recent.html", pages=pages)
 
 
 def find_user_display():
     if g.user is None:
-        return g.page.primary_diffs[-1]
+        return g.page.get_head()
     elif g.page.can_accept:
         return g.page.merged_diff
-    elif g.page.is_owner:
-        return g.page.primary_diffs[-1]
-    return g.page.user_primary_diff
+    elif g.page.is_owner or g.page.user_proposal_diff is None:
+        return g.page.get_head()
+    return g.page.user_proposal_diff
 
 
 @app.route("/page/<title>/")
 @error_handling
 def page(title):
     try:
-        g.page = Page.find(title)
+        g.page = Page.find(title, head=True)
     except PageNotFound as e:
         if g.user is None or not g.user.can_create:
             raise e
@@ -214,11 +230,11 @@ def page(title):
         return render_template(
             "user-page.html",
             display=display,
-            is_owner=g.user == g.page.owner,
+            is_owner=g.page.is_owner,
             display_email=display_email,
         )
     elif isinstance(g.page, TopicPage):
-        return render_template("topic-page.html", display=g.page.versions[-1])
+        return render_template("topic-page.html", display=g.page.get_head())
 
 
 @app.route("/bookmarks/")
@@ -228,14 +244,14 @@ def bookmarks():
         raise NotAllowed()
     g.page = BookmarksPage.find()
     links = g.page.latest.links
-    pages = list(
+    pages = (
         Page.objects.raw({"titles": {"$in": links}})
+        .project({"head": 0})
         .order_by([("last_edited", DESCENDING)])
         .limit(10)
+        .prefetch("latest", "user_version")
     )
-    return render_template(
-        "bookmarks-page.html", display=g.page.versions[-1], pages=pages
-    )
+    return render_template("bookmarks-page.html", display=g.page.latest, pages=pages)
 
 
 @app.route("/pageorbookmarks/")
@@ -249,18 +265,12 @@ def pageorbookmarks():
 
 @can_edit
 def view_user_edit():
-    if g.page.can_accept:
-        version = g.page.merged_version
-    elif g.page.is_owner:
-        version = g.page.versions[-1]
-    else:
-        version = g.page.user_version
-    return render_template("edit-user-page.html", version=version)
+    return render_template("edit-user-page.html", version=g.page.edit_version)
 
 
 @can_edit
 def view_topic_edit():
-    return render_template("edit-topic-page.html", version=g.page.versions[-1])
+    return render_template("edit-topic-page.html", version=g.page.latest)
 
 
 @app.route("/page/<title>/edit/")
@@ -279,17 +289,19 @@ def edit_bookmarks():
     if g.user is None:
         raise NotAllowed()
     g.page = BookmarksPage.find()
-    return render_template("edit-bookmarks-page.html", version=g.page.versions[-1])
+    return render_template("edit-bookmarks-page.html", version=g.page.latest)
 
 
 @user_page_errors
 @can_edit
 @catch_race
 def edit_user_page():
-    summary, sections = separate_sections(sanitize_html(get_param("body")))
+    links, sections, summary = clean_page(
+        get_param("body"), previous=g.page.edit_version
+    )
     name = sanitize_text(get_param("name"))
     aka = sanitize_text(get_param("aka"))
-    g.page.edit(sections, summary, name, aka)
+    g.page.edit(sections, summary, name, aka, links=links)
     return redirect(url_for("page", title=g.page.title))
 
 
@@ -297,9 +309,9 @@ def edit_user_page():
 @can_edit
 @catch_race
 def edit_topic_page():
-    summary, sections = separate_sections(sanitize_html(get_param("body")))
+    links, sections, summary = clean_page(get_param("body"), previous=g.page.latest)
     name = sanitize_text(get_param("name"))
-    g.page.edit(sections, summary, name)
+    g.page.edit(sections, summary, name, links=links)
     return redirect(url_for("page", title=g.page.title))
 
 
@@ -320,8 +332,8 @@ def bookmarks_submitedit():
     if g.user is None:
         raise NotAllowed()
     g.page = BookmarksPage.find()
-    summary, sections = separate_sections(sanitize_html(get_param("body")))
-    g.page.edit(sections, summary)
+    links, sections, summary = clean_page(get_param("body"), previous=g.page.latest)
+    g.page.edit(sections, summary, links=links)
     return redirect(url_for("bookmarks"))
 
 
@@ -362,7 +374,7 @@ def update_user_page():
             update_sections.append(idx)
 
     try:
-        g.page.edit(sections, summary, name, aka)
+        g.page.edit(sections, summary, name, aka, previous=old_version)
     except EmptyEdit:
         pass
 
@@ -411,12 +423,12 @@ def update_topic_page():
             update_sections.append(idx)
 
     try:
-        g.page.edit(sections, summary, name)
+        g.page.edit(sections, summary, name, previous=old_version)
     except EmptyEdit:
         pass
 
     html = {}
-    display = g.page.versions[-1]
+    display = g.page.latest
     if update_heading:
         html["heading"] = render_template("topic-page-heading.html", display=display)
     if update_summary:
@@ -469,12 +481,12 @@ def update_bookmarks():
             update_sections.append(idx)
 
     try:
-        g.page.edit(sections, summary)
+        g.page.edit(sections, summary, previous=old_version)
     except EmptyEdit:
         pass
 
     html = {}
-    display = g.page.versions[-1]
+    display = g.page.latest
     if update_summary:
         html["summary"] = render_template(
             "bookmarks-page-summary.html", display=display
@@ -490,7 +502,7 @@ def update_bookmarks():
 @can_edit
 @catch_race
 def restore_version(num):
-    if not 0 <= num < len(g.page.versions):
+    if not 0 <= num < g.page.num_versions:
         raise Malformed()
     g.page.restore(num)
     return reload()
@@ -554,13 +566,14 @@ def accept(title):
 @can_edit
 def flag_version(num):
     # TODO: partial rerendering
-    if not 1 <= num < len(g.page.versions) - 1:
+    if not 1 <= num < g.page.num_versions - 1:
         raise Malformed()
-    if g.page.versions[num].is_flagged:
+    version = g.page.get_version(num)
+    if version.is_flagged:
         raise AlreadyFlagged()
-    if g.page.versions[num].editor == g.user:
+    if version.editor == g.user:
         raise FlagYourself
-    g.page.versions[num].set_flag()
+    version.set_flag()
     return reload()
 
 
@@ -575,11 +588,12 @@ def flag(title):
 @page_errors
 @can_edit
 def unflag_version(num):
-    if not 1 <= num < len(g.page.versions) - 1:
+    if not 1 <= num < g.page.num_versions - 1:
         raise Malformed()
-    if not g.page.versions[num].is_flagged:
+    version = g.page.get_version(num)
+    if not version.is_flagged:
         return reload()
-    g.page.versions[num].set_unflag()
+    version.set_unflag()
     return reload()
 
 
@@ -596,13 +610,17 @@ def unflag(title):
 def version(title, num):
     g.page = Page.find(title)
     if isinstance(g.page, UserPage):
-        if not 0 <= num < len(g.page.versions):
+        if not 0 <= num < g.page.num_versions:
             raise Malformed()
-        return render_template("user-page-version.html", version=g.page.versions[num])
+        return render_template(
+            "user-page-version.html", version=g.page.get_version(num)
+        )
     elif isinstance(g.page, TopicPage):
-        if not 0 <= num < len(g.page.versions):
+        if not 0 <= num < g.page.num_versions:
             raise Malformed()
-        return render_template("topic-page-version.html", version=g.page.versions[num])
+        return render_template(
+            "topic-page-version.html", version=g.page.get_version(num)
+        )
 
 
 @app.route("/bookmarks/version/<int:num>/")
@@ -616,12 +634,22 @@ def bookmarks_version(num):
     return render_template("bookmarks-page-version.html", version=g.page.versions[num])
 
 
+def history_page(before=None):
+    # a page of edits, and the seq to go back from for the ones before them
+    history = g.page.history(before, app.config["HISTORY_PAGE_SIZE"])
+    if history and history[-1][0].seq > 0:
+        return history, history[-1][0].seq
+    return history, None
+
+
 def view_user_history():
-    return render_template("user-page-history.html")
+    history, older = history_page()
+    return render_template("user-page-history.html", history=history, older=older)
 
 
 def view_topic_history():
-    return render_template("topic-page-history.html")
+    history, older = history_page()
+    return render_template("topic-page-history.html", history=history, older=older)
 
 
 @app.route("/page/<title>/history/")
@@ -634,6 +662,22 @@ def history(title):
         return view_topic_history()
 
 
+@app.route("/page/<title>/history/older/", methods=["POST"])
+@error_handling
+def older_history(title):
+    before = get_param("before", int)
+    g.page = Page.find(title)
+    if not 0 < before <= g.page.num_versions:
+        raise Malformed()
+    history, older = history_page(before)
+    if isinstance(g.page, UserPage):
+        template = "user-page-history-entries.html"
+    elif isinstance(g.page, TopicPage):
+        template = "topic-page-history-entries.html"
+    html = render_template(template, history=history, older=older)
+    return rerender({"history-{}".format(before): html})
+
+
 @app.route("/bookmarks/history/")
 @error_handling
 def bookmarks_history():
@@ -660,9 +704,9 @@ def search(query):
         search_pages = [
             page for page in Page.search(query) if page not in bookmarks_pages
         ]
-        pages = bookmarks_pages + search_pages
+        pages = prefetch(bookmarks_pages + search_pages, "latest", "user_version")
     else:
-        pages = Page.search(query)
+        pages = prefetch(Page.search(query), "latest")
     return render_template(
         "search.html",
         pages=pages,
@@ -1,47 +1,50 @@
 from pymodm import fields, MongoModel, EmbeddedMongoModel
+from bson import ObjectId
 from pymongo.errors import DuplicateKeyError
 from flask import g
 
 from .page import Page, PageVersion, VersionDiff
+from .activity import Activity
 from .bookmarks import BookmarksPage
-from .html_utils import markup_changes, name_to_title, linkify_page, sanitize_html
-from .sections import diff_sections, Section, SectionDiff
+from .html_utils import name_to_title, linkify_page, sanitize_html
+from .sections import diff_bodies, diff_sections, Section, SectionDiff
+from .diff import DiffBudget
 from .app import timestamp, url_for, absolute_url
 from .errors import *
 
 
 class TopicPage(Page):
-    versions = fields.ListField(fields.ReferenceField("TopicVersion"))
-    diffs = fields.ListField(fields.ReferenceField("TopicVersionDiff"))
+    head = fields.EmbeddedDocumentField("TopicHead")
 
     @property
     def name(self):
-        return self.versions[-1].name
+        return self.latest.name
 
     def add_version(self, version, backlink=True):
         diff = TopicVersionDiff.compute(self.latest, version)
         if diff.is_empty:
             raise EmptyEdit()
         new_links = set(version.links).difference(self.latest.links)
-        version.save()
-        diff.save()
-        self.versions.append(version)
-        self.diffs.append(diff)
+        self.add_history(version, diff)
+        self.head = self.make_head()
         self.add_title(version.title)
         self.add_search_term(version.name)
         self.last_edited = version.timestamp
         try:
-            self.save_if_fresh()
+            self.update_if_fresh("head", "last_edited", inc={"num_versions": 1})
         except (RaceCondition, DuplicatePage):
-            version.delete()
-            diff.delete()
+            self.drop_history(version, diff)
             raise
+        Activity.record(self, diff)
         if backlink:
             self.trigger_backlinks(new_links)
 
-    @property
-    def latest(self):
-        return self.versions[-1]
+    def make_head(self):
+        return TopicHead(
+            sections=self.latest.sections,
+            summary=self.latest.summary,
+            name=self.latest.name,
+        )
 
     def add_backlink(self, titles):
         if set(titles).intersection(self.latest.links):
@@ -61,9 +64,12 @@ class TopicPage(Page):
             sections, self.latest.summary, self.latest.name, backlink=False
         )
 
-    def edit(self, sections, summary, name, backlink=True):
+    def edit(self, sections, summary, name, backlink=True, links=None, previous=None):
         assert g.user is not None
-        links, sections, summary = linkify_page(sections, summary)
+        if links is None:
+            links, sections, summary = linkify_page(
+                sections, summary, previous=previous
+            )
         version = TopicVersion(
             page=self,
             timestamp=timestamp(),
@@ -80,8 +86,8 @@ class TopicPage(Page):
             bookmarks.add_bookmark(self.title)
 
     def restore(self, num):
-        assert 0 <= num < len(self.versions) - 1
-        version = self.versions[num]
+        assert 0 <= num < self.num_versions - 1
+        version = self.get_version(num)
         self.edit(version.sections, version.summary, version.name)
 
     @staticmethod
@@ -98,27 +104,25 @@ class TopicPage(Page):
         )
         empty_version = TopicVersion(sections=[], summary="", name="")
         diff = TopicVersionDiff.compute(empty_version, version)
-        empty_version.save()
-        version.save()
-        diff.save()
+        # the history goes in first, under the id the page will have, so the
+        # page is never seen without it
         page = TopicPage(
+            _id=ObjectId(),
             titles=[version.title],
             search_terms=[name],
-            versions=[version],
-            diffs=[diff],
             last_edited=version.timestamp,
         )
+        empty_version.page = page
+        empty_version.save()
+        page.add_history(version, diff)
+        page.head = page.make_head()
         try:
-            page.save()
+            page.save(force_insert=True)
         except DuplicateKeyError:
             empty_version.delete()
-            version.delete()
-            diff.delete()
+            page.drop_history(version, diff)
             return Page.objects.get({"titles": version.title})
-        empty_version.page = page
-        version.page = page
-        empty_version.save()
-        version.save()
+        page.forget_names()
         page.trigger_backlinks(links)
         return page
 
@@ -131,6 +135,13 @@ class TopicPage(Page):
         return True
 
 
+class TopicHead(EmbeddedMongoModel):
+    # the latest version as the page shows it
+    sections = fields.EmbeddedDocumentListField(Section, blank=True)
+    summary = fields.CharField(blank=True)
+    name = fields.CharField(blank=True)
+
+
 class TopicVersion(PageVersion):
     sections = fields.EmbeddedDocumentListField(Section, blank=True)
     summary = fields.CharField(blank=True)
@@ -146,6 +157,7 @@ class TopicVersionDiff(VersionDiff):
     summary = fields.CharField(blank=True)
     summary_diff = fields.CharField(blank=True)
     summary_changed = fields.BooleanField()
+    summary_degraded = fields.BooleanField(default=False)
     name = fields.CharField(blank=True)
     prev_name = fields.CharField(blank=True)
 
@@ -163,8 +175,11 @@ class TopicVersionDiff(VersionDiff):
 
     @staticmethod
     def compute(version_a, version_b):
-        sections = diff_sections(version_a.sections, version_b.sections)
-        summary_diff = markup_changes(version_a.summary, version_b.summary)
+        budget = DiffBudget()
+        sections = diff_sections(version_a.sections, version_b.sections, budget=budget)
+        summary_diff, summary_degraded = diff_bodies(
+            version_a.summary, version_b.summary, False, budget
+        )
         name = version_b.name
         prev_name = version_a.name
         return TopicVersionDiff(
@@ -174,6 +189,7 @@ class TopicVersionDiff(VersionDiff):
             summary=version_b.summary,
             summary_diff=summary_diff,
             summary_changed=version_a.summary != version_b.summary,
+            summary_degraded=summary_degraded,
             name=name,
             prev_name=prev_name,
         )
@@ -1,29 +1,40 @@
 from pymodm import fields, MongoModel, EmbeddedMongoModel
 from pymodm.errors import DoesNotExist
+from bson import ObjectId
 from pymongo.errors import DuplicateKeyError
 from pymongo import ASCENDING, DESCENDING
 from pymongo.operations import IndexModel
 from flask import g, render_template
 from datetime import timedelta
 
-from .page import Page, PageVersion, VersionDiff
+from .page import Page, PageVersion, VersionDiff, history_index, ref_id
+from .activity import Activity
 from .html_utils import (
-    markup_changes,
     name_to_title,
     linkify_page,
     sanitize_html,
-    merge_html,
+    merge_script,
+    dump_script,
 )
-from .sections import diff_sections, Section, SectionDiff, separate_sections
+from .sections import (
+    diff_bodies,
+    diff_sections,
+    edited_sections,
+    merge_sections,
+    Section,
+    SectionDiff,
+)
+from .diff import DiffBudget
+from .offload import offload_merge_dumped
+from .cache import content_hash
 from .app import timestamp, url_for, absolute_url
 from .mail import send_email
 from .errors import *
 
 
 class UserPage(Page):
-    versions = fields.ListField(fields.ReferenceField("UserVersion"))
-    diffs = fields.ListField(fields.ReferenceField("UserVersionDiff"))
-    primary_diffs = fields.ListField(fields.ReferenceField("UserVersionDiff"))
+    primary_diff = fields.ReferenceField("UserVersionDiff")
+    head = fields.EmbeddedDocumentField("UserHead")
     primary_version = fields.ReferenceField("UserVersion")
     proposed_versions = fields.ListField(fields.ReferenceField("UserVersion"))
     merged_version = fields.ReferenceField("UserVersion")
@@ -34,17 +45,18 @@ class UserPage(Page):
 
     @property
     def name(self):
-        return "{} ({})".format(self.versions[-1].name, self.versions[-1].aka)
+        return "{} ({})".format(self.latest.name, self.latest.aka)
 
     @property
-    def user_primary_diff(self):
+    def user_proposal_diff(self):
+        # g.user's latest proposal diffed against the primary version, if any
         assert g.user is not None
-        if not hasattr(self, "_user_primary_diff"):
+        if not hasattr(self, "_user_proposal_diff"):
             try:
-                self._user_primary_diff = (
+                self._user_proposal_diff = (
                     UserVersionDiff.objects.raw(
                         {
-                            "version_a": self.primary_version._id,
+                            "version_a": ref_id(self, "primary_version"),
                             "editor": g.user._id,
                             "concise": True,
                         }
@@ -53,13 +65,61 @@ class UserPage(Page):
                     .first()
                 )
             except DoesNotExist:
-                self._user_primary_diff = self.primary_diffs[-1]
-        return self._user_primary_diff
+                self._user_proposal_diff = None
+        return self._user_proposal_diff
+
+    @property
+    def user_primary_diff(self):
+        if self.user_proposal_diff is None:
+            return self.primary_diff
+        return self.user_proposal_diff
 
     @property
     def user_version(self):
         assert g.user is not None
-        return self.user_primary_diff.version_b
+        if self.user_proposal_diff is None:
+            return self.primary_version
+        return self.user_proposal_diff.version_b
+
+    @staticmethod
+    def prefetch_user_version(pages):
+        # g.user's latest proposal for each page in one aggregation, then the
+        # versions they or the primary versions are in one more query
+        pages = [
+            page
+            for page in pages
+            if isinstance(page, UserPage) and not hasattr(page, "_user_proposal_diff")
+        ]
+        if not pages:
+            return
+        primary_ids = [ref_id(page, "primary_version") for page in pages]
+        proposals = {
+            document["_id"]: UserVersionDiff.from_document(document["diff"])
+            for document in UserVersionDiff.objects.raw(
+                {
+                    "version_a": {"$in": primary_ids},
+                    "editor": g.user._id,
+                    "concise": True,
+                }
+            ).aggregate(
+                {"$sort": {"timestamp": DESCENDING}},
+                {"$group": {"_id": "$version_a", "diff": {"$first": "$$ROOT"}}},
+            )
+        }
+        version_ids = [
+            ref_id(proposals[_id], "version_b") if _id in proposals else _id
+            for _id in primary_ids
+        ]
+        versions = {
+            version._id: version
+            for version in PageVersion.objects.raw({"_id": {"$in": version_ids}})
+        }
+        for page, primary_id, version_id in zip(pages, primary_ids, version_ids):
+            page._user_proposal_diff = proposals.get(primary_id)
+            if page._user_proposal_diff is None:
+                page.primary_version = versions[version_id]
+            else:
+                page._user_proposal_diff.version_b = versions[version_id]
 
     def add_user_version(self, version):
         # add to self.proposed_versions (and remove anything else by this editor)
@@ -74,23 +134,33 @@ class UserPage(Page):
         diff = UserVersionDiff.compute(self.user_version, version)
         if diff.is_empty:
             raise EmptyEdit()
-        delattr(self, "_user_primary_diff")
+        previous_primary_diff = self.user_primary_diff
+        delattr(self, "_user_proposal_diff")
         primary_diff = UserVersionDiff.compute(
-            self.primary_version, version, concise=True
+            self.primary_version, version, concise=True, previous=previous_primary_diff
+        )
+        version.store_merge_scripts(self.latest)
+        # merging can time out, so it's done before anything is saved
+        proposed_versions = [
+            proposal
+            for proposal in self.proposed_versions
+            if proposal.editor != version.editor
+        ]
+        proposed_versions.append(version)
+        merged_version = UserVersion.merge(self.latest, proposed_versions)
+        merged_diff = UserVersionDiff.compute(
+            self.latest, merged_version, previous=self.merged_diff
         )
+        self.proposed_versions = proposed_versions
+        self.merged_version = merged_version
+        self.merged_diff = merged_diff
         version.save()
         diff.save()
         primary_diff.save()
-        for proposal in self.proposed_versions:
-            if proposal.editor == version.editor:
-                self.proposed_versions.remove(proposal)
-        self.proposed_versions.append(version)
-        self.merged_version = UserVersion.merge(self.latest, self.proposed_versions)
-        self.merged_diff = UserVersionDiff.compute(self.latest, self.merged_version)
         self.merged_version.save()
         self.merged_diff.save()
         try:
-            self.save_if_fresh()
+            self.update_if_fresh("proposed_versions", "merged_version", "merged_diff")
         except (RaceCondition, DuplicatePage):
             version.delete()
             diff.delete()
@@ -101,8 +171,8 @@ class UserPage(Page):
 
     def add_primary_version(self, version, backlink=True):
         # make full diff with last version (which should be primary)
-        # make concise diff with self, add to primary_diffs
-        # add version to self.versions
+        # make concise diff with self, set as self.primary_diff
+        # add version and full diff to the history
         # reset self.proposed_versions
         # reset merged_version and merged_diff
         diff = UserVersionDiff.compute(self.latest, version)
@@ -113,12 +183,10 @@ class UserPage(Page):
             self.primary_version, version, concise=True
         )
         new_links = set(version.links).difference(self.latest.links)
-        version.save()
-        diff.save()
+        self.add_history(version, diff)
         primary_diff.save()
-        self.versions.append(version)
-        self.diffs.append(diff)
-        self.primary_diffs.append(primary_diff)
+        self.primary_diff = primary_diff
+        self.head = self.make_head()
         if version.title is not None:
             self.add_title(version.title)
         self.add_search_term(version.name)
@@ -127,18 +195,32 @@ class UserPage(Page):
         self.merged_version = None
         self.merged_diff = None
         try:
-            self.save_if_fresh()
+            self.update_if_fresh(
+                "primary_version",
+                "primary_diff",
+                "head",
+                "last_edited",
+                "proposed_versions",
+                "merged_version",
+                "merged_diff",
+                inc={"num_versions": 1},
+            )
         except (RaceCondition, DuplicatePage):
-            version.delete()
-            diff.delete()
+            self.drop_history(version, diff)
             primary_diff.delete()
             raise
+        Activity.record(self, diff)
         if backlink:
             self.trigger_backlinks(new_links)
 
-    @property
-    def latest(self):
-        return self.versions[-1]
+    def make_head(self):
+        return UserHead(
+            sections=self.primary_diff.sections,
+            summary=self.primary_diff.summary,
+            summary_diff=self.primary_diff.summary_diff,
+            name=self.primary_diff.name,
+            aka=self.primary_diff.aka,
+        )
 
     def add_backlink(self, titles):
         if self.is_owner:
@@ -167,11 +249,24 @@ class UserPage(Page):
             backlink=False,
         )
 
-    def edit(self, sections, summary, name, aka, is_primary=None, backlink=True):
+    def edit(
+        self,
+        sections,
+        summary,
+        name,
+        aka,
+        is_primary=None,
+        backlink=True,
+        links=None,
+        previous=None,
+    ):
         from .bookmarks import BookmarksPage
 
         assert g.user is not None
-        links, sections, summary = linkify_page(sections, summary)
+        if links is None:
+            links, sections, summary = linkify_page(
+                sections, summary, previous=previous
+            )
         if is_primary is None:
             is_primary = g.user == self.owner
         version = UserVersion(
@@ -197,7 +292,7 @@ class UserPage(Page):
             bookmarks.add_bookmark(self.title)
 
     def should_send_email(self, version):
-        if len(self.versions) == 1:
+        if self.num_versions == 1:
             num_pending = UserVersionDiff.objects.raw(
                 {"version_a": self.primary_version._id, "concise": True}
             ).count()
@@ -228,8 +323,8 @@ class UserPage(Page):
         )
 
     def restore(self, num):
-        assert 0 <= num < len(self.versions) - 1
-        version = self.versions[num]
+        assert 0 <= num < self.num_versions - 1
+        version = self.get_version(num)
         self.edit(
             version.sections,
             version.summary,
@@ -265,50 +360,47 @@ class UserPage(Page):
         empty_version = UserVersion(sections=[], summary="", name="", aka="")
         diff = UserVersionDiff.compute(empty_version, version)
         primary_diff = UserVersionDiff.compute(version, version, concise=True)
-        empty_version.save()
-        version.save()
-        diff.save()
-        primary_diff.save()
+        # the history goes in first, under the id the page will have, so the
+        # page is never seen without it
         page = UserPage(
+            _id=ObjectId(),
             titles=[email],
             search_terms=[],
-            versions=[version],
-            diffs=[diff],
-            primary_diffs=[primary_diff],
+            primary_diff=primary_diff,
             primary_version=version,
             owner=owner,
             last_edited=version.timestamp,
         )
+        empty_version.page = page
+        empty_version.save()
+        page.add_history(version, diff)
+        primary_diff.save()
+        page.head = page.make_head()
         try:
-            page.save()
+            page.save(force_insert=True)
         except DuplicateKeyError:
-            version.delete()
             empty_version.delete()
-            diff.delete()
+            page.drop_history(version, diff)
             primary_diff.delete()
             return Page.objects.get({"titles": email})
-        empty_version.page = page
-        version.page = page
-        empty_version.save()
-        version.save()
+        page.forget_names()
         return page
 
     def freeze(self):
         assert g.user == self.owner
         self.is_frozen = True
-        # this can overwrite a pending edit from someone else, but that's ok
-        self.save()
+        Page.objects.raw({"_id": self._id}).update({"$set": {"is_frozen": True}})
 
     def unfreeze(self):
         assert g.user == self.owner
         self.is_frozen = False
-        self.save()
+        Page.objects.raw({"_id": self._id}).update({"$set": {"is_frozen": False}})
 
     @property
     def can_edit(self):
         if g.user is None:
             return False
-        if g.user == self.owner:
+        if self.is_owner:
             return True
         if self.is_frozen:
             return False
@@ -320,18 +412,45 @@ class UserPage(Page):
     def is_owner(self):
         if g.user is None:
             return False
-        return g.user == self.owner
+        return g.user._id == ref_id(self, "owner")
 
     @property
     def can_accept(self):
         if g.user is None:
             return False
-        if g.user != self.owner:
+        if not self.is_owner:
             return False
-        if self.merged_diff is not None:
+        if ref_id(self, "merged_diff") is not None:
             return True
         return False
 
+    @property
+    def edit_version(self):
+        # the version the edit form starts from
+        if self.can_accept:
+            return self.merged_version
+        elif self.is_owner:
+            return self.latest
+        return self.user_version
+
+
+class UserHead(EmbeddedMongoModel):
+    # the primary diff as the page shows it
+    sections = fields.EmbeddedDocumentListField(SectionDiff, blank=True)
+    summary = fields.CharField(blank=True)
+    summary_diff = fields.CharField(blank=True)
+    name = fields.CharField(blank=True)
+    aka = fields.CharField(blank=True)
+
+    # it diffs the primary version against itself, so nothing changed
+    heading_changed = False
+
+    @property
+    def sections_dict(self):
+        return {
+            section.idx: section for section in self.sections if not section.deleted
+        }
+
 
 class UserVersion(PageVersion):
     sections = fields.EmbeddedDocumentListField(Section, blank=True)
@@ -339,21 +458,58 @@ class UserVersion(PageVersion):
     name = fields.CharField(blank=True)
     aka = fields.CharField(blank=True)
 
+    # a proposal's diffs against the bodies it edited, keyed by both bodies'
+    # digests, so merging in later proposals doesn't have to diff this one again
+    merge_scripts = fields.ListField(blank=True)
+
     @property
     def title(self):
         if self.name == "Placeholder Name":
             return None
         return name_to_title(self.name + " (" + self.aka + ")")
 
+    def store_merge_scripts(self, original):
+        edited = [
+            (section_a.body, section_b.body)
+            for section_a, section_b in edited_sections(
+                original.sections, self.sections
+            )
+        ]
+        if self.summary != original.summary:
+            edited.append((original.summary, self.summary))
+        self.merge_scripts = [
+            [
+                content_hash(body_a),
+                content_hash(body_b),
+                *dump_script(merge_script(body_a, body_b)),
+            ]
+            for body_a, body_b in edited
+        ]
+
     @staticmethod
     def merge(original, proposed):
-        original_body = render_template("user-page-body.html", version=original)
-        proposed_body_list = [
-            render_template("user-page-body.html", version=proposal)
+        stored = {}
+        for proposal in proposed:
+            for hash_a, hash_b, opcodes, inserts in proposal.merge_scripts:
+                stored[(hash_a, hash_b)] = (opcodes, inserts)
+        summary = original.summary
+        summaries = [
+            proposal.summary
             for proposal in proposed
+            if proposal.summary != original.summary
         ]
-        merged_body = merge_html(original_body, proposed_body_list)
-        summary, sections = separate_sections(merged_body)
+        if summaries:
+            hash_original = content_hash(original.summary)
+            if len(summaries) < len(proposed):
+                summaries.append(original.summary)
+            summary = offload_merge_dumped(
+                original.summary,
+                summaries,
+                [stored.get((hash_original, content_hash(data))) for data in summaries],
+            )
+        sections = merge_sections(
+            original.sections, [proposal.sections for proposal in proposed], stored
+        )
         new_names = [
             proposal.name for proposal in proposed if proposal.name != original.name
         ]
@@ -383,6 +539,7 @@ class UserVersionDiff(VersionDiff):
     summary = fields.CharField(blank=True)
     summary_diff = fields.CharField(blank=True)
     summary_changed = fields.BooleanField()
+    summary_degraded = fields.BooleanField(default=False)
     name = fields.CharField(blank=True)
     prev_name = fields.CharField(blank=True)
     aka = fields.CharField(blank=True)
@@ -409,6 +566,7 @@ class UserVersionDiff(VersionDiff):
                     ("concise", ASCENDING),
                 ]
             ),
+            history_index,
         ]
 
     @property
@@ -432,13 +590,24 @@ class UserVersionDiff(VersionDiff):
         )
 
     @staticmethod
-    def compute(version_a, version_b, concise=False):
+    def compute(version_a, version_b, concise=False, previous=None):
+        # previous is an earlier diff from version_a, with the same concise,
+        # whose sections and summary are reused where version_b didn't change
+        budget = DiffBudget()
         sections = diff_sections(
-            version_a.sections, version_b.sections, concise=concise
-        )
-        summary_diff = markup_changes(
-            version_a.summary, version_b.summary, concise=concise
+            version_a.sections,
+            version_b.sections,
+            concise=concise,
+            budget=budget,
+            previous=None if previous is None else previous.sections,
         )
+        if previous is not None and previous.summary == version_b.summary:
+            summary_diff = previous.summary_diff
+            summary_degraded = previous.summary_degraded
+        else:
+            summary_diff, summary_degraded = diff_bodies(
+                version_a.summary, version_b.summary, concise, budget
+            )
         name = version_b.name
         prev_name = version_a.name
         aka = version_b.aka
@@ -450,6 +619,7 @@ class UserVersionDiff(VersionDiff):
             summary=version_b.summary,
             summary_diff=summary_diff,
             summary_changed=version_a.summary != version_b.summary,
+            summary_degraded=summary_degraded,
             name=name,
             prev_name=prev_name,
             aka=aka,
@@ -1,3 +1,10 @@
 #!/bin/sh
 source venv/bin/activate
+flask create-activity
+# backlinks are only made while the worker runs, so restart it if it ever exits
+while true; do
+    flask backlinks-worker
+    echo "backlinks-worker exited with status $?, restarting" >&2
+    sleep 1
+done &
 exec gunicorn -b :5000 --access-logfile - --error-logfile - thread:app
@@ -0,0 +1,64 @@
+import random
+
+from bench_html import random_page
+from bench_pipeline import fuzz_page
+from bench_sanitize import bleach_sanitizer, fuzz_name
+from server.html_utils import (
+    HTMLSanitizer,
+    UnsupportedMarkup,
+    allowed_tags,
+    header_tags,
+    sanitize_html,
+    sanitize_paragraph,
+    sanitize_text,
+)
+
+sanitizers = [
+    ("sanitize_html", sanitize_html, allowed_tags + header_tags),
+    ("sanitize_paragraph", sanitize_paragraph, allowed_tags),
+    ("sanitize_text", sanitize_text, []),
+]
+
+
+def falls_back(html, tags):
+    parser = HTMLSanitizer(tags)
+    try:
+        parser.feed(html)
+        parser.close()
+    except UnsupportedMarkup:
+        return True
+    return False
+
+
+def count_mismatches(corpus):
+    # documents any sanitizer cleans differently than bleach.clean did
+    num_mismatches = 0
+    for name, sanitizer, tags in sanitizers:
+        reference = bleach_sanitizer(tags)
+        mismatches = [html for html in corpus if sanitizer(html) != reference(html)]
+        fallbacks = sum(falls_back(html, tags) for html in corpus)
+        print(
+            "{:<20} {} differ from bleach, {} fall back".format(
+                name, len(mismatches), fallbacks
+            )
+        )
+        for html in mismatches[:3]:
+            print("   ", repr(html))
+        num_mismatches += len(mismatches)
+    return num_mismatches
+
+
+def test_sanitizers_match_bleach():
+    rng = random.Random(0)
+    pages = [random_page(rng, num_sections=10) for _ in range(20)]
+    soup = [fuzz_page(rng) for _ in range(2000)]
+    names = [fuzz_name(rng) for _ in range(2000)]
+    num_mismatches = 0
+    for corpus_name, corpus in [("pages", pages), ("tag soup", soup), ("names", names)]:
+        print("{}, {} documents".format(corpus_name, len(corpus)))
+        num_mismatches += count_mismatches(corpus)
+    assert num_mismatches == 0, "{} documents differ from bleach".format(num_mismatches)
+
+
+if __name__ == "__main__":
+    test_sanitizers_match_bleach()